@@ -0,0 +1,47 @@
+"""
+Time initDB writing a synthetic library into a new database.
+
+    python benchmarks/bench_init.py [sizes...] [--batch N]
+"""
+from argparse import ArgumentParser
+from multiprocessing import get_context
+from os.path import join as pathJoin
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from synthetic import initRows
+
+DEFAULT_SIZES = [100000, 500000, 1000000]
+
+
+def timeInit(n: int, batchSize: int) -> float:
+    # Imported here; the app opens one database per process
+    from gallery.app import initDB
+
+    with TemporaryDirectory() as tmp:
+        start = perf_counter()
+        initDB(
+            dbPath=pathJoin(tmp, 'gallery.db'),
+            data=initRows(n),
+            commitBatchSize=batchSize
+        )
+        return perf_counter() - start
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('sizes', type=int, nargs='*', default=DEFAULT_SIZES)
+    parser.add_argument(
+        '--batch', type=int, default=200, help="commit_batch_size"
+    )
+    args = parser.parse_args()
+
+    # Fresh process per size
+    with get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        for n in args.sizes:
+            elapsed = pool.apply(timeInit, (n, args.batch))
+            print(f'{n:>9} rows  {elapsed:7.2f}s  {n / elapsed:9.0f} rows/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Memory held by the media catalog and index the server builds at startup,
+measured with tracemalloc over a synthetic library.
+
+    python benchmarks/bench_memory.py [sizes...]
+"""
+from argparse import ArgumentParser
+from gc import collect
+from multiprocessing import get_context
+import tracemalloc
+
+from synthetic import catalogRows
+
+DEFAULT_SIZES = [100000, 1000000]
+# One tag on every third media
+TAG_EVERY = 3
+
+
+def measure(n: int) -> (int, int):
+    from gallery.catalog import MediaCatalog
+    from gallery.bitmap import MediaIndex
+
+    mediaRows, pathRows = catalogRows(n)
+    tagRows = [
+        (row[0], f'tag{i % 20}')
+        for i, row in enumerate(mediaRows) if i % TAG_EVERY == 0
+    ]
+
+    # Input rows are not counted; the database cursor streams them
+    tracemalloc.start()
+    catalog = MediaCatalog.build('/library', iter(mediaRows), iter(pathRows))
+    index = MediaIndex(catalog, tagRows)
+    collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del catalog, index
+    return retained, peak
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('sizes', type=int, nargs='*', default=DEFAULT_SIZES)
+    args = parser.parse_args()
+
+    # Fresh process per size so peaks do not carry over
+    with get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        for n in args.sizes:
+            retained, peak = pool.apply(measure, (n,))
+            print(
+                f'{n:>9} media  retained {retained / 1e6:7.1f} MB '
+                f'({retained / n:5.0f} B/media)  peak {peak / 1e6:7.1f} MB'
+            )
+
+
+if __name__ == '__main__':
+    main()
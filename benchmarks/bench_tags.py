@@ -0,0 +1,77 @@
+"""
+Time tag writes through the API: add, re-add, rename and remove a batch of
+tags on many media of a synthetic library.
+
+    python benchmarks/bench_tags.py [--size N] [--media N] [--tags N]
+"""
+from argparse import ArgumentParser
+from os.path import join as pathJoin
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from synthetic import initRows, mediaHash
+
+
+def timeRequest(name: str, request):
+    start = perf_counter()
+    resp = request()
+    elapsed = perf_counter() - start
+    print(f'{name:<16} {resp.status_code}  {elapsed:7.2f}s')
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--size', type=int, default=100000, help="Media in the library"
+    )
+    parser.add_argument(
+        '--media', type=int, default=10000, help="Media tagged per request"
+    )
+    parser.add_argument(
+        '--tags', type=int, default=10, help="Tags per request"
+    )
+    args = parser.parse_args()
+
+    from gallery.app import initDB, saveCatalog, createApp
+    from gallery.indexer import ThumbnailOptions
+
+    with TemporaryDirectory() as tmp:
+        dbPath = pathJoin(tmp, 'gallery.db')
+        initDB(dbPath=dbPath, data=initRows(args.size), commitBatchSize=5000)
+        saveCatalog(dbPath)
+        app = createApp(
+            thumbnails=ThumbnailOptions(
+                dir=pathJoin(tmp, 'thumbnails'),
+                sizes=[300],
+                formats=['jpg'],
+                quality={}
+            ),
+            configFolder=tmp,
+            dbPath=dbPath,
+            thumbnailWorkers=1
+        )
+        client = app.test_client()
+
+        hashes = [
+            mediaHash(i)
+            for i in Random(0).sample(range(args.size), args.media)
+        ]
+        tags = [f'bench{i}' for i in range(args.tags)]
+        print(f'{args.media} media x {args.tags} tags of {args.size}')
+        timeRequest('add', lambda: client.post(
+            '/api/tags', json={'hashes': hashes, 'tag': tags}
+        ))
+        timeRequest('add again', lambda: client.post(
+            '/api/tags', json={'hashes': hashes, 'tag': tags}
+        ))
+        timeRequest('rename', lambda: client.put(
+            '/api/tags', json={'old_tag': tags[0], 'new_tag': tags[1]}
+        ))
+        timeRequest('remove', lambda: client.delete(
+            '/api/tags', json={'hashes': hashes, 'tags': tags}
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Synthetic library shared by the benchmarks"""
+from collections import defaultdict
+from hashlib import sha1
+
+EXTENSIONS = ['jpg', 'png', 'heic', 'mp4']
+
+
+def mediaHash(i: int) -> str:
+    return sha1(str(i).encode()).hexdigest()
+
+
+def mediaPath(i: int) -> str:
+    ext = EXTENSIONS[i % len(EXTENSIONS)]
+    album = f'photos/{2000 + i % 25}/{i % 12:02d}/album{i % 300}'
+    return f'{album}/IMG_{i:08d}.{ext}'
+
+
+def initRows(n: int):
+    """Rows as init passes them to initDB, one path per media"""
+    for i in range(n):
+        video = i % len(EXTENSIONS) == 3
+        yield defaultdict(lambda: None, {
+            'hash': mediaHash(i),
+            'path': mediaPath(i),
+            'datetime': 1600000000 + i * 37,
+            'size': 2500000 + i,
+            'width': 4000,
+            'height': 3000,
+            'aspectratio': 4000 / 3000,
+            'video': video,
+            'duration': '0:00:12' if video else None,
+            'hashalgorithm': 'sha1',
+            'mtime': 1600000000000000000 + i,
+            'inode': i
+        })
+
+
+def catalogRows(n: int) -> (list, list):
+    """Media rows in hash order and path rows in path order"""
+    mediaRows = sorted(
+        (
+            mediaHash(i), 4000 / 3000, i % 4 == 3,
+            '0:00:12' if i % 4 == 3 else None,
+            90 if i % 7 == 0 else None,
+            4000, 3000, 2500000 + i, 1600000000.0 + i * 37
+        )
+        for i in range(n)
+    )
+    pathRows = sorted(
+        (
+            mediaPath(i), mediaHash(i), EXTENSIONS[i % 4],
+            1600000000000000000 + i
+        )
+        for i in range(n)
+    )
+    return mediaRows, pathRows
@@ -2,25 +2,41 @@ from pathlib import Path
 from os import fspath
 from os.path import join as pathJoin
 from os.path import dirname, exists, isabs, normpath, abspath
-from media.metadataExtract import MetaExtract
-from media.thumbnails import ImgThumbnail, VidThumbnail
-from media.mediatype import MediaType, GetMediaType
-from utils.filehash import SHA1
 from utils.paths import CreatePath
 from gallery.app import createApp, initDB
+from gallery.app import getScanManifest, removeMissingPaths, saveCatalog
+from gallery.app import getQuickHashes, getUnverifiedMedia, saveVerification
+from gallery.app import getVideoDurations
+from gallery.indexer import processAll, prefetch, thumbnailsExist
+from gallery.indexer import generateAll
+from gallery.indexer import resolveQuickCollisions, SCAN_QUEUE_SIZE
+from gallery.indexer import ThumbnailOptions
+from gallery.server import runServer
+from utils.filehash import GetHasher, HashFile, FullAlgorithm
+from utils.filehash import DEFAULT_ALGORITHM, QUICK_PREFIX
 import tomllib
 from collections import defaultdict
 import argparse
 
 
-def thumbnailPath(hash: str, size: int) -> (str, str):
-    return (
-        f'{hash[:2]}/{hash[2:4]}/',
-        f'{hash[4:]}-{size}.jpg'
+# Stored media paths are relative to the config directory
+def originalPath(config: dict, path: str) -> str:
+    if isabs(path):
+        return path
+    return pathJoin(config['config_dir'], path)
+
+
+def thumbnailOptions(config: dict, thumbnailDir: str) -> ThumbnailOptions:
+    extraFormats = config["media"].get("thumbnail_formats", [])
+    return ThumbnailOptions(
+        dir=thumbnailDir,
+        sizes=config["media"]["thumbnail_size"],
+        formats=['jpg'] + [f for f in extraFormats if f != 'jpg'],
+        quality=config["media"].get("thumbnail_quality", {})
     )
 
 
-def initialize(config: dict):
+def initialize(config: dict, workers: int = None):
     MEDIA_PATH = config["paths"]["media"]
     # Path is relative
     if not isabs(MEDIA_PATH):
@@ -32,66 +48,225 @@ def initialize(config: dict):
         DATA_PATH = pathJoin(config['config_dir'], DATA_PATH)
 
     DATABASE_NAME = "gallery.db"
-    THUMBNAIL_PATH = pathJoin(DATA_PATH, "thumbnails")
-    THUMBNAIL_SIZES = config["media"]["thumbnail_size"]
+    THUMBNAILS = thumbnailOptions(
+        config, pathJoin(DATA_PATH, "thumbnails")
+    )
+    # Leave thumbnails to be generated by the server on request
+    if not config.get("init", {}).get("thumbnails", True):
+        THUMBNAILS = THUMBNAILS._replace(sizes=[])
+
+    INIT_CONFIG = config.get("init", {})
+    HASH_ALGORITHM = INIT_CONFIG.get("hash_algorithm", DEFAULT_ALGORITHM)
+    HASH_MMAP = INIT_CONFIG.get("hash_mmap", False)
+    QUICK_HASH = INIT_CONFIG.get("quick_hash", False)
 
-    HASH_METHOD = SHA1
+    # Command line overrides config
+    if workers is None:
+        workers = INIT_CONFIG.get("workers", 1)
+
+    try:
+        GetHasher(HASH_ALGORITHM)
+    except ValueError as e:
+        print(e)
+        return
 
     CreatePath(DATA_PATH)
+    dbPath = pathJoin(abspath(DATA_PATH), DATABASE_NAME)
 
-    MEDIA_PATH_LEN = len(MEDIA_PATH)
+    MEDIA_ROOT = Path(MEDIA_PATH)
+    STORED_PREFIX = pathJoin(normpath(config["paths"]["media"]), '')
 
     # Directories to skip
     skipPaths = (abspath(DATA_PATH))
-    metadataList = []
 
-    # Recursively list all files
-    for fpath in Path(MEDIA_PATH).rglob('*'):
-        mediaPath = fspath(fpath)
+    # Quick hashes are kept while quick mode is on; small files are
+    # always hashed in full
+    acceptedAlgorithms = {HASH_ALGORITHM}
+    if QUICK_HASH:
+        acceptedAlgorithms.add(QUICK_PREFIX + HASH_ALGORITHM)
 
-        if fpath.is_dir() or abspath(mediaPath).startswith(skipPaths):
-            continue
+    # Stat signatures from last scan
+    manifest = getScanManifest(dbPath)
+    hashBySignature = {
+        entry[:3]: (entry[3], entry[4]) for entry in manifest.values()
+        if entry[4] in acceptedAlgorithms
+    }
+    # Unchanged files hashed with a different algorithm
+    previousHashes = {}
+    seenPaths = set()
+    # Hash to path of unchanged files missing a thumbnail
+    thumbnailTasks = {}
+    unchanged, moved = 0, 0
+    scanComplete = False
 
-        metadata = MetaExtract(mediaPath)
-        # Not supported; skip
-        if metadata is None:
-            print(f"Cannot extract metadata from {mediaPath}")
-            continue
-
-        hash = HASH_METHOD(mediaPath)
-        metadata['hash'] = hash
-        metadata['path'] = pathJoin(
-            normpath(config["paths"]["media"]),
-            mediaPath[MEDIA_PATH_LEN:]
+    def storedPath(mediaPath: str) -> str:
+        # Path normalises away './', so slicing by length is unreliable
+        return pathJoin(
+            STORED_PREFIX, fspath(Path(mediaPath).relative_to(MEDIA_ROOT))
         )
-        metadata['aspectratio'] = metadata['width'] / metadata['height']
 
-        for tSize in THUMBNAIL_SIZES:
-            tpath = pathJoin(
-                THUMBNAIL_PATH,
-                ''.join(thumbnailPath(hash, tSize))
-            )
-            if exists(tpath):
+    def mediaFiles():
+        nonlocal unchanged, moved, scanComplete
+        # Recursively list all files
+        for fpath in MEDIA_ROOT.rglob('*'):
+            mediaPath = fspath(fpath)
+
+            if fpath.is_dir() or abspath(mediaPath).startswith(skipPaths):
                 continue
 
-            print(f"Generating {tpath}")
-            {
-                MediaType.IMAGE: ImgThumbnail,
-                MediaType.VIDEO: VidThumbnail
-            }[GetMediaType(mediaPath)](
-                # Arguments to thumbnailer
-                mediaPath,
-                tpath,
-                tSize
+            path = storedPath(mediaPath)
+            seenPaths.add(path)
+
+            # Dangling symlink or deleted mid-scan; kept as seen so the
+            # next scan decides
+            try:
+                fstat = fpath.stat()
+            except OSError as e:
+                print(f'Cannot stat {mediaPath}: {e}')
+                continue
+            signature = (fstat.st_size, fstat.st_mtime_ns, fstat.st_ino)
+
+            # Skip if unchanged since last scan
+            entry = manifest.get(path)
+            if entry is not None and entry[:3] == signature:
+                if entry[4] not in acceptedAlgorithms:
+                    previousHashes[path] = entry[3]
+                else:
+                    unchanged += 1
+                    # Content unchanged; only render what is missing
+                    if not thumbnailsExist(entry[3], THUMBNAILS):
+                        thumbnailTasks[entry[3]] = mediaPath
+                    continue
+
+            # Moved or renamed; reuse hash
+            elif entry is None and signature in hashBySignature:
+                moved += 1
+                hash, algorithm = hashBySignature[signature]
+                yield (mediaPath, {
+                    'hash': hash,
+                    'size': fstat.st_size,
+                    'mtime': fstat.st_mtime_ns,
+                    'inode': fstat.st_ino,
+                    'hashalgorithm': algorithm,
+                    'moved': True
+                })
+                continue
+
+            yield (mediaPath, None)
+
+        scanComplete = True
+
+    def metadataStream():
+        for mediaPath, metadata in processAll(
+            prefetch(mediaFiles(), SCAN_QUEUE_SIZE),
+            thumbnails=THUMBNAILS,
+            workers=workers,
+            hashAlgorithm=HASH_ALGORITHM,
+            hashMmap=HASH_MMAP,
+            quickHash=QUICK_HASH
+        ):
+            # Not supported; skip
+            if metadata is None:
+                continue
+
+            metadata['path'] = storedPath(mediaPath)
+            metadata['previoushash'] = previousHashes.pop(
+                metadata['path'], None
             )
+            yield (mediaPath, defaultdict(lambda: None, metadata))
 
-        metadataList.append(defaultdict(lambda: None, metadata))
+    rows = metadataStream()
+    if QUICK_HASH:
+        rows = resolveQuickCollisions(
+            rows,
+            knownQuick=getQuickHashes(dbPath),
+            manifest=manifest,
+            resolvePath=lambda path: originalPath(config, path),
+            thumbnails=THUMBNAILS,
+            hashMmap=HASH_MMAP
+        )
 
     initDB(
-        dbPath=pathJoin(abspath(DATA_PATH), DATABASE_NAME),
-        data=metadataList,
+        dbPath=dbPath,
+        data=(row for _, row in rows),
         commitBatchSize=config["database"]["commit_batch_size"]
     )
+    print(f'{unchanged} unchanged, {moved} moved files.')
+
+    if thumbnailTasks:
+        durations = getVideoDurations(dbPath)
+        generateAll(
+            (
+                (mediaPath, hash, durations.get(hash))
+                for hash, mediaPath in thumbnailTasks.items()
+            ),
+            thumbnails=THUMBNAILS,
+            workers=workers
+        )
+
+    # Unmounted root lists nothing; do not treat the library as deleted
+    if scanComplete and MEDIA_ROOT.is_dir():
+        removeMissingPaths(
+            dbPath, STORED_PREFIX, seenPaths,
+            maxMissingRatio=INIT_CONFIG.get("max_missing_ratio", 0.5)
+        )
+    else:
+        print('Scan incomplete; missing paths not removed.')
+    # Servers map this at startup instead of loading the database
+    saveCatalog(dbPath)
+
+
+def verify(config: dict):
+    """Compute full hashes for media keyed by a quick hash"""
+    dbPath = pathJoin(config["paths"]["data"], "gallery.db")
+    # Path is relative
+    if not isabs(dbPath):
+        dbPath = pathJoin(config['config_dir'], dbPath)
+
+    if not exists(dbPath):
+        print(f'Cannot find database file "{dbPath}".')
+        return
+
+    HASH_MMAP = config.get("init", {}).get("hash_mmap", False)
+    COMMIT_BATCH_SIZE = config["database"]["commit_batch_size"]
+
+    fullHashes, collided = {}, []
+    verified, collisions = 0, 0
+    dbPath = abspath(dbPath)
+    for hash, (algorithm, paths) in getUnverifiedMedia(dbPath).items():
+        pathHashes = {}
+        for path in paths:
+            try:
+                pathHashes[path] = HashFile(
+                    originalPath(config, path),
+                    FullAlgorithm(algorithm),
+                    useMmap=HASH_MMAP
+                )
+            except FileNotFoundError:
+                print(f"Cannot find {path}")
+        if not pathHashes:
+            continue
+
+        # Paths sharing a quick hash must share content; the smallest path
+        # is the one init compares new files against
+        firstHash = next(iter(pathHashes.values()))
+        mismatched = [p for p, h in pathHashes.items() if h != firstHash]
+        fullHashes[hash] = firstHash
+        collided.extend(mismatched)
+        for path in mismatched:
+            print(f"Quick hash collision: {path}")
+        verified += 1
+        collisions += len(mismatched)
+
+        if len(fullHashes) >= COMMIT_BATCH_SIZE:
+            saveVerification(dbPath, fullHashes, collided)
+            fullHashes, collided = {}, []
+
+    saveVerification(dbPath, fullHashes, collided)
+    saveCatalog(dbPath)
+    print(f'{verified} verified, {collisions} collisions found.')
+    if collisions:
+        print('Run init again to re-index collided files.')
 
 
 def server(config: dict):
@@ -111,16 +286,15 @@ def server(config: dict):
             abspath(config['config_dir']), thumbnailsFolder
         )
 
-    createApp(
-        thumbnailFolder=thumbnailsFolder,
+    app = createApp(
+        thumbnails=thumbnailOptions(config, thumbnailsFolder),
         configFolder=config['config_dir'],
         dbPath=abspath(dbPath),
-        thumbnailSizes=config["media"]["thumbnail_size"]
-    ).run(
-        debug=True,
-        host=config['server']['host'],
-        port=config['server']['port']
+        thumbnailWorkers=config['server'].get('thumbnail_workers', 2),
+        thumbnailQueueSize=config['server'].get('thumbnail_queue', 256),
+        cacheOptions=config.get('cache', {})
     )
+    runServer(app, config['server'])
 
 
 # Entry point
@@ -136,6 +310,16 @@ def main():
         action="store_true",
         help="Run in init mode"
     )
+    parser.add_argument(
+        "-v", "--verify",
+        action="store_true",
+        help="Verify quick hashes with full content hashes"
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int, default=None,
+        help="Number of init worker processes, 0 to use all cores"
+    )
     args = parser.parse_args()
 
     if not exists(args.config):
@@ -148,7 +332,12 @@ def main():
 
     if args.init:
         print("Running initialization.")
-        initialize(config)
+        initialize(config, workers=args.workers)
+        return
+
+    if args.verify:
+        print("Running verification.")
+        verify(config)
         return
 
     server(config)
@@ -1,124 +1,406 @@
 from flask import Flask, render_template
-from os.path import exists, basename, abspath
-from models import db, init_db
-from models.models import Media, MediaPath
+from os.path import exists, abspath
+from models import db, init_db, catalog_version, bump_catalog_version
+from models.models import Media, MediaPath, MediaTag, ScanEntry
+from sqlalchemy import String, bindparam, delete, insert, select, update
+from sqlalchemy import func as sqlfunc
+from sqlalchemy.dialects.sqlite import insert as sqliteInsert
 from gallery.routes import bp
-from gallery.media import getMediaInfo
+from gallery.media import getTagRows
+from gallery.indexer import ThumbnailOptions
+from gallery.thumbnailer import ThumbnailQueue
+from gallery.cache import ResponseCache
+from gallery.bitmap import MediaIndex
+from gallery.catalog import loadCatalog, openCatalog, snapshotPath
+from utils.filehash import DEFAULT_ALGORITHM, QUICK_PREFIX
+from utils.paths import SplitMediaPath
 
 app = Flask(__name__, static_folder=None)
 
 
+def openDB(dbPath: str):
+    # Already opened
+    if 'sqlalchemy' in app.extensions:
+        return
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{dbPath}'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    init_db(app)
+
+
+def getScanManifest(dbPath: str) -> dict:
+    """
+    Map of path to (size, mtime, inode, hash, hash algorithm) from the
+    last scan
+    """
+    openDB(dbPath)
+
+    with app.app_context():
+        return {
+            row.path: (
+                row.size, row.mtime, row.inode, row.hash, row.hashalgorithm
+            )
+            for row in db.session.query(ScanEntry).all()
+        }
+
+
 def initDB(
     dbPath: str,
-    data: list,
+    data,
     commitBatchSize: int
 ):
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{dbPath}'
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    init_db(app)
+    openDB(dbPath)
 
     with app.app_context():
-        # Get list of hash and paths
-        mediaPaths = [p[0] for p in db.session.query(MediaPath.path).all()]
-        mediaHashes = [p[0] for p in db.session.query(Media.hash).all()]
-        # if already in skip
+        # Get hashes, and paths with their hash
+        mediaPaths = dict(
+            db.session.query(MediaPath.path, MediaPath.hash).all()
+        )
+        mediaHashes = {h for (h,) in db.session.query(Media.hash).all()}
 
-        currBatchSize = 0
         # Track number of hash and path duplicates
         hashDupe, pathDupe = 0, 0
-        rows = []
+        mediaRows, pathRows, changedPaths, scanEntries = [], [], [], []
+        rekeyed, verified = [], []
         for row in data:
-            # Only add if not already in db
-            if row['hash'] not in mediaHashes:
-                rows.append(Media(
-                    hash=row['hash'],
-                    datetime=row['datetime'],
-                    size=row['size'],
-                    width=row['width'],
-                    height=row['height'],
-                    aspectratio=row['aspectratio'],
-                    video=row['video'],
-                    duration=row['duration'],
-                ))
-                currBatchSize += 1
-                mediaHashes.append(row['hash'])
+            hashAlgorithm = row['hashalgorithm'] or DEFAULT_ALGORITHM
+
+            # Only add if not already in db; moved files carry no metadata
+            if row['hash'] not in mediaHashes and not row['moved']:
+                mediaRows.append({
+                    'hash': row['hash'],
+                    'datetime': row['datetime'],
+                    'size': row['size'],
+                    'width': row['width'],
+                    'height': row['height'],
+                    'aspectratio': row['aspectratio'],
+                    'video': row['video'],
+                    'duration': row['duration'],
+                    'hashalgorithm': hashAlgorithm,
+                    'fullhash': row['fullhash'],
+                })
+                mediaHashes.add(row['hash'])
             else:
                 hashDupe += 1
+                # Quick hash collision verified as duplicate
+                if row['fullhash']:
+                    verified.append({
+                        'b_hash': row['hash'],
+                        'b_full': row['fullhash']
+                    })
+
             if row['path'] not in mediaPaths:
-                rows.append(MediaPath(
-                    path=row['path'],
-                    hash=row['hash']
-                ))
-                currBatchSize += 1
-                mediaPaths.append(row['path'])
+                parentDir, extension = SplitMediaPath(row['path'])
+                pathRows.append({
+                    'path': row['path'],
+                    'hash': row['hash'],
+                    'parent_dir': parentDir,
+                    'extension': extension
+                })
+                mediaPaths[row['path']] = row['hash']
+            elif mediaPaths[row['path']] != row['hash']:
+                # File content changed
+                changedPaths.append({
+                    'b_path': row['path'],
+                    'b_hash': row['hash']
+                })
+                mediaPaths[row['path']] = row['hash']
             else:
                 pathDupe += 1
 
-            # Commit in batch
-            if currBatchSize >= commitBatchSize:
-                db.session.add_all(rows)
+            # Rehashed with another algorithm; keep tags and rotation
+            if row['previoushash'] and row['previoushash'] != row['hash']:
+                rekeyed.append({
+                    'b_old': row['previoushash'],
+                    'b_new': row['hash']
+                })
+
+            if row['mtime'] is not None:
+                scanEntries.append({
+                    'path': row['path'],
+                    'hash': row['hash'],
+                    'hashalgorithm': hashAlgorithm,
+                    'size': row['size'],
+                    'mtime': row['mtime'],
+                    'inode': row['inode']
+                })
+
+            # Commit in batch so progress survives interruption
+            if (
+                len(mediaRows) + len(pathRows) + len(changedPaths) >=
+                commitBatchSize or
+                len(scanEntries) >= commitBatchSize
+            ):
+                insertRows(
+                    mediaRows, pathRows, changedPaths, scanEntries,
+                    rekeyed, verified
+                )
+                bump_catalog_version()
                 db.session.commit()
-                currBatchSize = 0
-                rows = []
+                mediaRows, pathRows, changedPaths, scanEntries = [], [], [], []
+                rekeyed, verified = [], []
 
-        db.session.add_all(rows)
+        insertRows(
+            mediaRows, pathRows, changedPaths, scanEntries, rekeyed, verified
+        )
+        bump_catalog_version()
         db.session.commit()
         print(f'{hashDupe} hash, {pathDupe} path duplicates not added.')
 
 
+def insertRows(
+    mediaRows: list[dict],
+    pathRows: list[dict],
+    changedPaths: list[dict],
+    scanEntries: list[dict],
+    rekeyed: list[dict],
+    verified: list[dict]
+):
+    """Bulk write a batch of rows with executemany"""
+    if mediaRows:
+        db.session.execute(
+            sqliteInsert(Media.__table__).on_conflict_do_nothing(),
+            mediaRows
+        )
+    if pathRows:
+        db.session.execute(
+            sqliteInsert(MediaPath.__table__).on_conflict_do_nothing(),
+            pathRows
+        )
+    if changedPaths:
+        db.session.execute(
+            update(MediaPath.__table__)
+            .where(MediaPath.__table__.c.path == bindparam('b_path'))
+            .values(hash=bindparam('b_hash')),
+            changedPaths
+        )
+    if rekeyed:
+        tags = MediaTag.__table__
+        db.session.execute(
+            insert(tags).prefix_with('OR IGNORE').from_select(
+                ['hash', 'tag'],
+                select(bindparam('b_new', type_=String), tags.c.tag)
+                .where(tags.c.hash == bindparam('b_old'))
+            ),
+            rekeyed
+        )
+        # Tags moved once no path is left on the old hash; duplicates
+        # rekeyed in a later batch copy from it first
+        paths = MediaPath.__table__
+        db.session.execute(
+            delete(tags)
+            .where(tags.c.hash == bindparam('b_old'))
+            .where(~(
+                select(paths.c.path)
+                .where(paths.c.hash == bindparam('b_old'))
+                .exists()
+            )),
+            rekeyed
+        )
+        media, oldMedia = Media.__table__, Media.__table__.alias()
+        db.session.execute(
+            update(media)
+            .where(media.c.hash == bindparam('b_new'))
+            .values(rotation=(
+                select(oldMedia.c.rotation)
+                .where(oldMedia.c.hash == bindparam('b_old'))
+                .scalar_subquery()
+            )),
+            rekeyed
+        )
+    if verified:
+        setFullHashes(verified)
+    if scanEntries:
+        stmt = sqliteInsert(ScanEntry.__table__)
+        db.session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[ScanEntry.__table__.c.path],
+                set_={
+                    'hash': stmt.excluded.hash,
+                    'hashalgorithm': stmt.excluded.hashalgorithm,
+                    'size': stmt.excluded.size,
+                    'mtime': stmt.excluded.mtime,
+                    'inode': stmt.excluded.inode
+                }
+            ),
+            scanEntries
+        )
+
+
+def setFullHashes(verified: list[dict]):
+    media = Media.__table__
+    db.session.execute(
+        update(media)
+        .where(media.c.hash == bindparam('b_hash'))
+        .values(fullhash=bindparam('b_full')),
+        verified
+    )
+
+
+def getVideoDurations(dbPath: str) -> dict:
+    """Map of video hash to duration, for thumbnails of known media"""
+    openDB(dbPath)
+
+    with app.app_context():
+        return dict(
+            db.session.query(Media.hash, Media.duration)
+            .filter(Media.video.is_(True))
+            .all()
+        )
+
+
+def getQuickHashes(dbPath: str) -> dict:
+    """Map of quick hash to [path, full hash or None]"""
+    openDB(dbPath)
+
+    with app.app_context():
+        rows = (
+            db.session.query(
+                Media.hash, sqlfunc.min(MediaPath.path), Media.fullhash
+            )
+            .join(MediaPath.media)
+            .filter(Media.hashalgorithm.startswith(QUICK_PREFIX))
+            .group_by(Media.hash)
+            .all()
+        )
+        return {hash: [path, fullHash] for hash, path, fullHash in rows}
+
+
+def getUnverifiedMedia(dbPath: str) -> dict:
+    """Map of quick hash without a full hash to (algorithm, sorted paths)"""
+    openDB(dbPath)
+
+    with app.app_context():
+        rows = (
+            db.session.query(Media.hash, Media.hashalgorithm, MediaPath.path)
+            .join(MediaPath.media)
+            .filter(
+                Media.hashalgorithm.startswith(QUICK_PREFIX),
+                Media.fullhash.is_(None)
+            )
+            # First path is the reference, as in getQuickHashes
+            .order_by(MediaPath.path)
+            .all()
+        )
+
+    media = {}
+    for hash, algorithm, path in rows:
+        media.setdefault(hash, (algorithm, []))[1].append(path)
+    return media
+
+
+def saveVerification(dbPath: str, fullHashes: dict, collided: list[str]):
+    """
+    Store verified full hashes. Paths whose content did not match their
+    quick hash are dropped from the manifest so the next init re-keys them.
+    """
+    openDB(dbPath)
+
+    with app.app_context():
+        if fullHashes:
+            setFullHashes([
+                {'b_hash': hash, 'b_full': full}
+                for hash, full in fullHashes.items()
+            ])
+        if collided:
+            db.session.query(ScanEntry).filter(
+                ScanEntry.path.in_(collided)
+            ).delete(synchronize_session=False)
+        bump_catalog_version()
+        db.session.commit()
+
+
+def removeMissingPaths(
+    dbPath: str, pathPrefix: str, seenPaths: set, maxMissingRatio: float = 0.5
+):
+    """Remove paths under prefix which were not found in the last scan"""
+    openDB(dbPath)
+
+    with app.app_context():
+        known = {p for (p,) in db.session.query(MediaPath.path).all()}
+        known.update(p for (p,) in db.session.query(ScanEntry.path).all())
+        missing = [
+            p for p in known
+            if p.startswith(pathPrefix) and p not in seenPaths
+        ]
+
+        # Most of the library vanishing is more likely an unmounted or
+        # renamed root than deleted media
+        scanned = sum(1 for p in known if p.startswith(pathPrefix))
+        if missing and len(missing) > scanned * maxMissingRatio:
+            print(
+                f'{len(missing)} of {scanned} paths missing; not removing. '
+                'Raise init.max_missing_ratio to allow this.'
+            )
+            return
+
+        # Chunk to stay below SQLite variable limit
+        CHUNK_SIZE = 500
+        for i in range(0, len(missing), CHUNK_SIZE):
+            chunk = missing[i:i + CHUNK_SIZE]
+            db.session.query(MediaPath).filter(
+                MediaPath.path.in_(chunk)
+            ).delete(synchronize_session=False)
+            db.session.query(ScanEntry).filter(
+                ScanEntry.path.in_(chunk)
+            ).delete(synchronize_session=False)
+        bump_catalog_version()
+        db.session.commit()
+        print(f'{len(missing)} missing paths removed.')
+
+
+def saveCatalog(dbPath: str):
+    """Write the catalog snapshot the server maps at startup"""
+    openDB(dbPath)
+
+    with app.app_context():
+        # Read first; data newer than the version only forces a rebuild
+        version = catalog_version()
+        loadCatalog('').save(snapshotPath(dbPath), version)
+
+
 def createApp(
-    thumbnailFolder: str,
+    thumbnails: ThumbnailOptions,
     configFolder: str,
     dbPath: str,
-    thumbnailSizes: list[int]
+    thumbnailWorkers: int = 2,
+    thumbnailQueueSize: int = 256,
+    cacheOptions: dict = {}
 ) -> Flask:
     if not exists(dbPath):
         print(f'Database file {dbPath} not found.')
         return
 
-    defaultThumbnailSize = min(thumbnailSizes)
-
-    def thumbnailPrefix(hash: str) -> (str, str):
-        return (
-            f'{hash[:2]}/{hash[2:4]}/',
-            f'{hash[4:]}'
-        )
+    defaultThumbnailSize = min(thumbnails.sizes)
 
-    app.config['media_cache'] = {}
+    app.config['media_cache'] = ResponseCache(
+        maxEntries=cacheOptions.get('max_entries', 256),
+        maxBytes=cacheOptions.get('max_bytes', 64 * 1024 * 1024),
+        ttl=cacheOptions.get('ttl', 3600)
+    )
     app.config['JSON_SORT_KEYS'] = False
 
-    app.config['thumbnailSizes'] = thumbnailSizes
+    app.config['thumbnailSizes'] = thumbnails.sizes
+    app.config['thumbnailFormats'] = thumbnails.formats
     app.config['defaultThumbnailSize'] = defaultThumbnailSize
-    app.config['thumbnailDir'] = thumbnailFolder
+    app.config['thumbnailDir'] = thumbnails.dir
+    # Missing thumbnails are generated on request
+    app.config['thumbnailQueue'] = ThumbnailQueue(
+        thumbnails,
+        workers=thumbnailWorkers,
+        maxPending=thumbnailQueueSize
+    )
     app.config['configDir'] = abspath(configFolder)
+    app.config['dbPath'] = dbPath
 
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{dbPath}'
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    init_db(app)
+    openDB(dbPath)
 
-    # Create list of media info and paths from database
+    # Catalog of media so serving never queries the database
     with app.app_context():
-        rows = getMediaInfo()
-
-        app.config['mediaInfo'] = []
-        app.config['mediaPath'] = {}
-        for row in rows:
-            app.config['mediaInfo'].append({
-                'hash': row[0],
-                'name': basename(row[1]),
-                'aspectRatio': row[2],
-                'video': row[3],
-                'duration': row[4],
-                'rotation': row[5],
-                'width': row[6],
-                'height': row[7],
-                'path': row[1],
-                'size': row[8]
-            })
-            app.config['mediaPath'][row[0]] = {
-                'thumbnailPrefix': ''.join(thumbnailPrefix(row[0])),
-                'original': row[1]
-            }
+        catalog = openCatalog(dbPath, app.config['configDir'])
+        app.config['mediaCatalog'] = catalog
+        # Filters of /api/media answered in memory
+        app.config['mediaIndex'] = MediaIndex(catalog, getTagRows())
 
     app.register_blueprint(bp)
 
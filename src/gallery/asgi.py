@@ -0,0 +1,119 @@
+import asyncio
+import sys
+from io import BytesIO
+from re import compile as reCompile
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask
+from asgiref.wsgi import WsgiToAsgi
+
+# Thumbnail and original routes served without holding a thread
+MEDIA_ROUTE = reCompile(r'^/media/[^/]+/(thumbnail(/[^/]+)?|original)$')
+
+
+def buildEnviron(scope: dict) -> dict:
+    """WSGI environ of a bodiless ASGI http request"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client')
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client[0] if client else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin1'), value.decode('latin1')
+        if name in ('content-type', 'content-length'):
+            key = name.upper().replace('-', '_')
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        # Repeated headers are comma joined
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class MediaASGI:
+    """
+    ASGI app serving thumbnails and originals on an event loop. Flask
+    views build the response in a fixed thread pool and the body is read
+    from it a chunk at a time, so slow clients hold no thread while
+    waiting. Other routes run through the WSGI app.
+    """
+
+    def __init__(self, app: Flask, threads: int = 8):
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads,
+            thread_name_prefix='media'
+        )
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope['type'] == 'http' and
+            scope['method'] in ('GET', 'HEAD') and
+            MEDIA_ROUTE.match(scope['path'])
+        ):
+            await self.serveMedia(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    def dispatch(self, environ: dict):
+        """Run the Flask view; returns WSGI body, status and headers"""
+        with self.app.request_context(environ):
+            try:
+                resp = self.app.full_dispatch_request()
+            except Exception as e:
+                resp = self.app.make_response(self.app.handle_exception(e))
+            return resp.get_wsgi_response(environ)
+
+    async def serveMedia(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        body, status, headers = await loop.run_in_executor(
+            self.executor, self.dispatch, buildEnviron(scope)
+        )
+
+        disconnected = asyncio.Event()
+
+        async def watchDisconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = asyncio.create_task(watchDisconnect())
+        chunks = iter(body)
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [
+                    (name.lower().encode('latin1'), value.encode('latin1'))
+                    for name, value in headers
+                ],
+            })
+            while not disconnected.is_set():
+                chunk = await loop.run_in_executor(
+                    self.executor, next, chunks, None
+                )
+                if chunk is None:
+                    break
+                await send({
+                    'type': 'http.response.body',
+                    'body': chunk,
+                    'more_body': True
+                })
+            await send({'type': 'http.response.body', 'more_body': False})
+        finally:
+            watcher.cancel()
+            if hasattr(body, 'close'):
+                await loop.run_in_executor(self.executor, body.close)
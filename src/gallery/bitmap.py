@@ -0,0 +1,199 @@
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from threading import Lock
+from gallery.media import prefixUpperBound
+
+
+def bitsetFromIds(ids, size: int) -> int:
+    """Python int with the bits of ids set"""
+    data = bytearray((size + 7) // 8)
+    for i in ids:
+        data[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(data, 'little')
+
+
+def iterBits(bitset: int, start: int = 0):
+    """Set bits of bitset in increasing order, from bit start"""
+    # Least significant bit first
+    bits = bin(bitset)[:1:-1]
+    i = bits.find('1', start)
+    while i != -1:
+        yield i
+        i = bits.find('1', i + 1)
+
+
+# Matches below 1 in this many are sorted rather than found in order
+SPARSE_RATIO = 16
+
+
+class MediaIndex:
+    """
+    In-memory index answering /api/media filters with bitwise operations.
+    Ids are the catalog's path ids, which are in path order, so path
+    prefixes are id ranges and ids come out of a bitset already sorted by
+    path. Tags, extensions and the video flag are bitsets over these ids.
+    """
+
+    def __init__(self, catalog, tagRows):
+        """tagRows as (hash, tag) in hash order"""
+        self.lock = Lock()
+        self.catalog = catalog
+        self.size = len(catalog)
+        self.paths = catalog.paths
+        self.all = (1 << self.size) - 1
+
+        # Stored by the catalog as bytes
+        self.videos = int.from_bytes(catalog.videoBits, 'little')
+        self.extensions = {
+            ext: int.from_bytes(bits, 'little')
+            for ext, bits in zip(
+                catalog.extensionNames, catalog.extensionBits
+            )
+        }
+        self.setTags(tagRows)
+
+        self.timeOrder = catalog.timeOrder
+        self.timeKey = catalog.timeKey
+        # Library version the tags and rotations reflect
+        self.version = 0
+
+    def idsOf(self, hashes) -> int:
+        pathIds = self.catalog.pathIds
+        return bitsetFromIds(
+            (
+                i for m, _ in self.catalog.resolve(
+                    (hash, None) for hash in sorted(set(hashes))
+                )
+                for i in pathIds(m)
+            ),
+            self.size
+        )
+
+    def setTags(self, tagRows):
+        """tagRows as (hash, tag) in hash order"""
+        tagIds, pathIds = {}, self.catalog.pathIds
+        for m, tag in self.catalog.resolve(tagRows):
+            tagIds.setdefault(tag, []).extend(pathIds(m))
+        self.tags = {
+            tag: bitsetFromIds(ids, self.size) for tag, ids in tagIds.items()
+        }
+
+    def addTags(self, tags, hashes):
+        bits = self.idsOf(hashes)
+        with self.lock:
+            for tag in tags:
+                self.tags[tag] = self.tags.get(tag, 0) | bits
+
+    def removeTags(self, tags, hashes=None):
+        """Remove tags from hashes, or from all media if hashes is None"""
+        removed = self.all if hashes is None else self.idsOf(hashes)
+        with self.lock:
+            for tag in tags:
+                bits = self.tags.get(tag, 0) & ~removed
+                if bits:
+                    self.tags[tag] = bits
+                else:
+                    self.tags.pop(tag, None)
+
+    def renameTag(self, oldTag: str, newTag: str):
+        with self.lock:
+            bits = self.tags.pop(oldTag, 0)
+            if bits:
+                self.tags[newTag] = self.tags.get(newTag, 0) | bits
+
+    def reload(self, tagRows, rotations: dict, version: int):
+        """Replace tags and rotations changed by another process"""
+        with self.lock:
+            self.setTags(tagRows)
+            self.catalog.setRotations(rotations)
+            self.version = version
+
+    def match(
+        self,
+        pathFilter: str = None,
+        tagsFilter: list = None,
+        itagsFilter: list = None,
+        typeFilter: list = None
+    ) -> (int, int):
+        """Bitset of matching ids, and first id that can match"""
+        bits, start = self.all, 0
+
+        # Prefix is a range of ids
+        if pathFilter:
+            start = bisect_left(self.paths, pathFilter)
+            upperBound = prefixUpperBound(pathFilter)
+            end = len(self.paths) if upperBound is None else bisect_left(
+                self.paths, upperBound
+            )
+            bits &= ((1 << end) - 1) >> start << start
+
+        if typeFilter:
+            typeBits = None
+            if "video" in typeFilter and "image" not in typeFilter:
+                typeBits = self.videos
+            elif "video" not in typeFilter and "image" in typeFilter:
+                typeBits = self.all ^ self.videos
+
+            for ext in typeFilter:
+                if ext in ("video", "image"):
+                    continue
+                typeBits = (typeBits or 0) | self.extensions.get(
+                    ext.lower(), 0
+                )
+            if typeBits is not None:
+                bits &= typeBits
+
+        for tag in tagsFilter or []:
+            bits &= self.tags.get(tag, 0)
+
+        for tag in itagsFilter or []:
+            bits &= ~self.tags.get(tag, 0)
+
+        return (bits, start)
+
+    def query(
+        self,
+        pathFilter: str = None,
+        tagsFilter: list = None,
+        itagsFilter: list = None,
+        typeFilter: list = None,
+        sort: str = 'path',
+        after: list = None,
+        limit: int = None
+    ) -> list:
+        """Rows as getMediaInfo would return them"""
+        bits, start = self.match(
+            pathFilter, tagsFilter, itagsFilter, typeFilter
+        )
+        rows, row = [], self.catalog.row
+        if limit == 0:
+            return rows
+
+        if sort == 'datetime':
+            key = None if after is None else (-after[0], after[1])
+            # Few matches; sorting them beats walking the whole order
+            if bits.bit_count() * SPARSE_RATIO < self.size:
+                matched = sorted(iterBits(bits), key=self.timeKey)
+                pos = 0 if key is None else bisect_right(
+                    matched, key, key=self.timeKey
+                )
+                return [row(i) for i in matched[pos:][:limit]]
+
+            pos = 0 if key is None else bisect_right(
+                self.timeOrder, key, key=self.timeKey
+            )
+            matched = bin(bits)[:1:-1]
+            for i in islice(self.timeOrder, pos, None):
+                if i < len(matched) and matched[i] == '1':
+                    rows.append(row(i))
+                    if len(rows) == limit:
+                        break
+            return rows
+
+        if after is not None:
+            start = max(start, bisect_right(self.paths, after[0]))
+        for i in iterBits(bits, start):
+            rows.append(row(i))
+            if len(rows) == limit:
+                break
+        return rows
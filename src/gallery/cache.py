@@ -0,0 +1,151 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic, time_ns
+from hashlib import sha1
+from multiprocessing import Value
+
+
+class ResponseCache:
+    """
+    LRU cache of response bodies bounded by entry count and total bytes.
+    Entries record the tags their filter depends on so tag writes only
+    drop affected entries. Every invalidation bumps the library version
+    that ETags are derived from. The version lives in shared memory so
+    forked server workers drop their entries on another worker's write.
+    """
+
+    def __init__(
+        self,
+        maxEntries: int = 256,
+        maxBytes: int = 64 * 1024 * 1024,
+        ttl: float = 3600
+    ):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+
+        # key -> (body, encoding, tags, expiry)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.lock = Lock()
+
+        # Start time keeps ETags unique across restarts
+        self.epoch = time_ns() // 1000000
+        self.sharedVersion = Value('q', 0)
+        # Version the entries were cached at
+        self.seenVersion = 0
+
+    @property
+    def version(self) -> int:
+        return self.sharedVersion.value
+
+    def etag(self, *parts) -> str:
+        """Strong ETag for parts at the current library version"""
+        digest = sha1(repr(parts).encode()).hexdigest()[:16]
+        return f'{self.epoch:x}.{self.version}.{digest}'
+
+    def get(self, key) -> tuple | None:
+        """Body and its content encoding"""
+        with self.lock:
+            self._sync()
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # Expired
+            if entry[3] < monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[:2]
+
+    def put(
+        self,
+        key,
+        body: bytes,
+        encoding: str = 'identity',
+        tags: frozenset = frozenset(),
+        version: int = None
+    ):
+        """version is the library version body was read at"""
+        # Larger than the whole cache
+        if len(body) > self.maxBytes:
+            return
+
+        with self.lock:
+            self._sync()
+            # Library changed while body was built
+            if version is not None and version != self.seenVersion:
+                return
+
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (
+                body, encoding, tags, monotonic() + self.ttl
+            )
+            self.bytes += len(body)
+
+            # Evict least recently used
+            while (
+                len(self.entries) > self.maxEntries or
+                self.bytes > self.maxBytes
+            ):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidateTags(self, tags) -> int | None:
+        """
+        Drop entries whose filter includes any of tags. Returns the new
+        version, or None if another process had changed the library too.
+        """
+        tags = set(tags)
+        with self.lock, self.sharedVersion.get_lock():
+            version = self._bump()
+            for key in [
+                k for k, entry in self.entries.items()
+                if not tags.isdisjoint(entry[2])
+            ]:
+                self._remove(key)
+            return version
+
+    def clear(self) -> int | None:
+        with self.lock, self.sharedVersion.get_lock():
+            version = self._bump()
+            self.entries.clear()
+            self.bytes = 0
+            return version
+
+    def stats(self) -> dict:
+        with self.lock:
+            self._sync()
+            return {
+                'version': self.version,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def _sync(self):
+        # Another process changed the library; tags unknown, drop all
+        if self.sharedVersion.value != self.seenVersion:
+            self.entries.clear()
+            self.bytes = 0
+            self.seenVersion = self.sharedVersion.value
+
+    def _bump(self) -> int | None:
+        foreign = self.sharedVersion.value != self.seenVersion
+        self._sync()
+        self.sharedVersion.value += 1
+        self.seenVersion = self.sharedVersion.value
+        return None if foreign else self.seenVersion
+
+    def _remove(self, key):
+        body = self.entries.pop(key)[0]
+        self.bytes -= len(body)
@@ -0,0 +1,470 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from fcntl import flock, LOCK_EX
+from mmap import mmap, ACCESS_READ
+from os import fstat, getpid, replace, stat
+from os.path import join as pathJoin, splitext
+from struct import Struct, calcsize, pack, error as StructError
+from sys import byteorder
+from time import monotonic
+import json
+from sqlalchemy import func as sqlfunc, exists
+from models import db, catalog_version
+from models.models import Media, MediaPath, ScanEntry
+from gallery.media import MediaRecord
+from gallery.bitmap import bitsetFromIds
+
+# Stand-in for None in integer columns
+MISSING = -1
+# One in this many hashes kept as a str to narrow lookups
+FENCE_STEP = 64
+# Rows fetched at a time while loading
+LOAD_BATCH_SIZE = 10000
+
+# Catalog snapshot, native byte order:
+#   magic, uint32 directory length, int64 catalog version
+#   JSON directory of columns as name: [format, offset, count] from the
+#   end of the directory, extension names and byte order
+#   columns, each padded to 8 bytes
+SNAPSHOT_MAGIC = b'SGK1'
+SNAPSHOT_HEADER = Struct('<4sIq')
+VERSION_OFFSET = 8
+# Typed columns saved in snapshots; string columns save data and offsets
+ARRAY_COLUMNS = (
+    'media', 'extension', 'mtime', 'aspectRatio', 'video', 'rotation',
+    'width', 'height', 'fileSize', 'datetime', 'byMedia', 'mediaStart',
+    'timeOrder', 'videoBits'
+)
+STRING_COLUMNS = ('paths', 'hashes', 'durations')
+# Seconds between checks for a snapshot rewritten by init
+SNAPSHOT_CHECK_INTERVAL = 2
+
+
+def snapshotPath(dbPath: str) -> str:
+    return splitext(dbPath)[0] + '.catalog'
+
+
+class StringColumn:
+    """Strings stored back to back as UTF-8, read by index"""
+
+    def __init__(self, data: bytearray = None, offsets: array = None):
+        self.data = data if data is not None else bytearray()
+        self.offsets = offsets if offsets is not None else array('Q', [0])
+
+    def append(self, s: str):
+        self.data += s.encode()
+        self.offsets.append(len(self.data))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        # Data may be a memoryview of a snapshot
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+
+class MediaCatalog:
+    """
+    Media library held in typed columns rather than per item objects.
+    Path ids follow path order and media ids follow hash order, so both
+    are found by bisect without a dict. Rows and records are built on
+    demand. Columns are arrays, or read-only views of a memory-mapped
+    snapshot shared by all processes through the page cache.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        # Per path
+        self.paths = StringColumn()
+        self.media = array('I')
+        self.extension = array('H')
+        self.extensionNames = []
+        self.mtime = array('q')
+        # Per media
+        self.hashes = StringColumn()
+        self.aspectRatio = array('d')
+        self.video = array('b')
+        # Images have no duration, stored as empty
+        self.durations = StringColumn()
+        self.rotation = array('h')
+        self.width = array('I')
+        self.height = array('I')
+        self.fileSize = array('q')
+        self.datetime = array('d')
+        # Path ids of media m are byMedia[mediaStart[m]:mediaStart[m + 1]]
+        self.byMedia = array('I')
+        self.mediaStart = array('I', [0])
+        # Path ids newest first, undated last, path as tiebreaker
+        self.timeOrder = array('I')
+        # Bitsets over path ids as little-endian bytes, per extension in
+        # extensionNames order
+        self.videoBits = b''
+        self.extensionBits = []
+        self.hashFence = []
+
+        # Mapped snapshot, if any
+        self.snapshot = None
+        self.inode = None
+        self.rotationOffset = None
+        self.checked = monotonic()
+
+    @classmethod
+    def build(cls, root: str, mediaRows, pathRows):
+        """
+        Catalog of media rows (hash, aspectratio, video, duration,
+        rotation, width, height, size, datetime) in hash order and path
+        rows (path, hash, extension, mtime) in path order.
+        """
+        catalog = cls(root)
+        mediaIds = {}
+        for row in mediaRows:
+            mediaIds[row[0]] = len(mediaIds)
+            catalog.hashes.append(row[0])
+            catalog.aspectRatio.append(row[1])
+            catalog.video.append(row[2])
+            catalog.durations.append(row[3] or '')
+            catalog.rotation.append(MISSING if row[4] is None else row[4])
+            catalog.width.append(row[5])
+            catalog.height.append(row[6])
+            catalog.fileSize.append(row[7])
+            catalog.datetime.append(row[8])
+
+        extensionIds, videoIds, extensionPaths = {}, [], []
+        counts = array('I', bytes(4 * len(mediaIds)))
+        for path, hash, extension, mtime in pathRows:
+            m = mediaIds.get(hash)
+            if m is None:
+                continue
+            i = len(catalog.media)
+            if extension not in extensionIds:
+                extensionIds[extension] = len(extensionIds)
+                extensionPaths.append([])
+            extensionPaths[extensionIds[extension]].append(i)
+            if catalog.video[m]:
+                videoIds.append(i)
+            catalog.paths.append(path)
+            catalog.media.append(m)
+            catalog.extension.append(extensionIds[extension])
+            catalog.mtime.append(MISSING if mtime is None else mtime)
+            counts[m] += 1
+        del mediaIds
+        catalog.extensionNames = list(extensionIds)
+
+        # Group path ids by media, in path order within each media
+        for count in counts:
+            catalog.mediaStart.append(catalog.mediaStart[-1] + count)
+        catalog.byMedia = array('I', sorted(
+            range(len(catalog.media)), key=catalog.media.__getitem__
+        ))
+        timeKeys = [catalog.timeKey(i) for i in range(len(catalog))]
+        catalog.timeOrder = array(
+            'I', sorted(range(len(catalog)), key=timeKeys.__getitem__)
+        )
+        del timeKeys
+
+        size = len(catalog)
+        catalog.videoBits = bitsetFromIds(videoIds, size).to_bytes(
+            (size + 7) // 8, 'little'
+        )
+        catalog.extensionBits = [
+            bitsetFromIds(ids, size).to_bytes((size + 7) // 8, 'little')
+            for ids in extensionPaths
+        ]
+        catalog.setFence()
+        return catalog
+
+    def setFence(self):
+        self.hashFence = [
+            self.hashes[m] for m in range(0, len(self.hashes), FENCE_STEP)
+        ]
+
+    def save(self, path: str, version: int):
+        """Write a snapshot, replacing any previous one atomically"""
+        columns = {name: getattr(self, name) for name in ARRAY_COLUMNS}
+        for name in STRING_COLUMNS:
+            columns[f'{name}.data'] = getattr(self, name).data
+            columns[f'{name}.offsets'] = getattr(self, name).offsets
+        for i, bits in enumerate(self.extensionBits):
+            columns[f'extensionBits.{i}'] = bits
+
+        directory, offset = {}, 0
+        for name, column in columns.items():
+            view = memoryview(column)
+            directory[name] = [view.format, offset, len(view)]
+            offset += view.nbytes + (-view.nbytes % 8)
+        directory = json.dumps({
+            'columns': directory,
+            'extensionNames': self.extensionNames,
+            'byteorder': byteorder
+        }).encode()
+
+        header = SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, len(directory), version
+        ) + directory
+        # Unique per process; init and servers may rebuild at once
+        tmpPath = f'{path}.{getpid()}.tmp'
+        with open(tmpPath, 'wb') as f:
+            f.write(header + bytes(-len(header) % 8))
+            for column in columns.values():
+                nbytes = memoryview(column).nbytes
+                f.write(column)
+                f.write(bytes(-nbytes % 8))
+        # Processes mapping the old snapshot keep reading it until reload
+        replace(tmpPath, path)
+
+    @classmethod
+    def fromSnapshot(cls, path: str, root: str) -> tuple | None:
+        """Catalog mapped from a snapshot and its version, None if invalid"""
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap(f.fileno(), 0, access=ACCESS_READ)
+                inode = fstat(f.fileno()).st_ino
+            magic, length, version = SNAPSHOT_HEADER.unpack_from(mapped)
+            end = SNAPSHOT_HEADER.size + length
+            directory = json.loads(mapped[SNAPSHOT_HEADER.size:end])
+            if magic != SNAPSHOT_MAGIC or directory['byteorder'] != byteorder:
+                return None
+
+            start = end + (-end % 8)
+            view = memoryview(mapped)
+
+            def column(name: str) -> memoryview:
+                format, offset, count = directory['columns'][name]
+                offset += start
+                end = offset + count * calcsize(format)
+                # Truncated or corrupt snapshot
+                if offset < start or count < 0 or end > len(mapped):
+                    raise ValueError(f"Column '{name}' out of bounds")
+                return view[offset:end].cast(format)
+
+            catalog = cls(root)
+            for name in ARRAY_COLUMNS:
+                setattr(catalog, name, column(name))
+            for name in STRING_COLUMNS:
+                setattr(catalog, name, StringColumn(
+                    column(f'{name}.data'), column(f'{name}.offsets')
+                ))
+            catalog.extensionNames = directory['extensionNames']
+            catalog.extensionBits = [
+                column(f'extensionBits.{i}')
+                for i in range(len(catalog.extensionNames))
+            ]
+            for name in STRING_COLUMNS:
+                strings = getattr(catalog, name)
+                if (
+                    len(strings.offsets) == 0 or
+                    strings.offsets[-1] > len(strings.data)
+                ):
+                    raise ValueError(f"Column '{name}' out of bounds")
+            catalog.setFence()
+        except FileNotFoundError:
+            return None
+        except (
+            OSError, ValueError, KeyError, TypeError, IndexError, StructError
+        ) as e:
+            print(f'Cannot read catalog snapshot {path}: {e}')
+            return None
+
+        catalog.snapshot = path
+        catalog.inode = inode
+        catalog.rotationOffset = start + directory['columns']['rotation'][1]
+        return (catalog, version)
+
+    def replaced(self) -> bool:
+        """
+        Whether the mapped snapshot was rewritten since, checked at most
+        every SNAPSHOT_CHECK_INTERVAL seconds
+        """
+        if (
+            self.snapshot is None or
+            monotonic() - self.checked < SNAPSHOT_CHECK_INTERVAL
+        ):
+            return False
+        self.checked = monotonic()
+        try:
+            return stat(self.snapshot).st_ino != self.inode
+        except OSError:
+            return False
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def mediaId(self, hash: str) -> int | None:
+        # Fence narrows the search to one step of the column
+        k = bisect_right(self.hashFence, hash) - 1
+        if k < 0:
+            return None
+        lo = k * FENCE_STEP
+        hi = min(lo + FENCE_STEP, len(self.hashes))
+        m = bisect_left(self.hashes, hash, lo, hi)
+        if m < hi and self.hashes[m] == hash:
+            return m
+        return None
+
+    def timeKey(self, i: int) -> tuple:
+        return (-self.datetime[self.media[i]], self.paths[i])
+
+    def resolve(self, rows):
+        """
+        (media id, value) of (hash, value) rows in hash order, skipping
+        unknown hashes. Each search gallops on from the previous match.
+        """
+        n, m = len(self.hashes), 0
+        for hash, value in rows:
+            lo, probe, step = m, m, 1
+            while probe < n and self.hashes[probe] < hash:
+                lo = probe + 1
+                probe = lo + step
+                step *= 2
+            m = bisect_left(self.hashes, hash, lo, min(probe, n))
+            if m < n and self.hashes[m] == hash:
+                yield (m, value)
+
+    def pathIds(self, m: int):
+        return self.byMedia[self.mediaStart[m]:self.mediaStart[m + 1]]
+
+    def row(self, i: int) -> tuple:
+        """Path i as a getMediaInfo row"""
+        m = self.media[i]
+        rotation = self.rotation[m]
+        return (
+            self.hashes[m],
+            self.paths[i],
+            self.aspectRatio[m],
+            bool(self.video[m]),
+            self.durations[m] or None,
+            None if rotation == MISSING else rotation,
+            self.width[m],
+            self.height[m],
+            self.fileSize[m],
+            self.datetime[m],
+            self.extensionNames[self.extension[i]]
+        )
+
+    def setRotation(
+        self,
+        hash: str,
+        rotation: int | None,
+        version: int = None
+    ):
+        """
+        Set rotation of hash. A mapped snapshot is patched in place, seen
+        by every process mapping it, and marked at catalog version if it
+        was current before this write.
+        """
+        m = self.mediaId(hash)
+        if m is None:
+            return
+        rotation = MISSING if rotation is None else rotation
+        if self.snapshot is None:
+            self.rotation[m] = rotation
+            return
+
+        try:
+            with open(self.snapshot, 'r+b') as f:
+                # Writers take turns so versions are marked in order
+                flock(f, LOCK_EX)
+                # Rewritten since mapped; the reload reads it from there
+                if fstat(f.fileno()).st_ino != self.inode:
+                    return
+                f.seek(self.rotationOffset + m * self.rotation.itemsize)
+                f.write(pack('=h', rotation))
+                f.seek(0)
+                current = SNAPSHOT_HEADER.unpack(
+                    f.read(SNAPSHOT_HEADER.size)
+                )[2]
+                if version is not None and current == version - 1:
+                    f.seek(VERSION_OFFSET)
+                    f.write(pack('<q', version))
+        except OSError as e:
+            print(f'Cannot update catalog snapshot {self.snapshot}: {e}')
+
+    def setRotations(self, rotations: dict):
+        """Replace rotations changed by another process"""
+        # Mapped snapshots are patched by the writing process
+        if self.snapshot is not None:
+            return
+        for m in range(len(self.hashes)):
+            rotation = rotations.get(self.hashes[m])
+            self.rotation[m] = MISSING if rotation is None else rotation
+
+    # Mapping of hash to MediaRecord for serving files
+    def __contains__(self, hash: str) -> bool:
+        return self.mediaId(hash) is not None
+
+    def __getitem__(self, hash: str) -> MediaRecord:
+        record = self.get(hash)
+        if record is None:
+            raise KeyError(hash)
+        return record
+
+    def get(self, hash: str, default=None) -> MediaRecord | None:
+        m = self.mediaId(hash)
+        if m is None:
+            return default
+        # Any path of the media serves the same content
+        i = self.byMedia[self.mediaStart[m]]
+        mtime, rotation = self.mtime[i], self.rotation[m]
+        return MediaRecord(
+            original=pathJoin(self.root, self.paths[i]),
+            size=self.fileSize[m],
+            video=bool(self.video[m]),
+            mtime=None if mtime == MISSING else mtime,
+            duration=self.durations[m] or None,
+            rotation=None if rotation == MISSING else rotation
+        )
+
+
+def openCatalog(dbPath: str, root: str) -> MediaCatalog:
+    """
+    Catalog mapped from the snapshot next to the database. An outdated
+    or missing snapshot is rebuilt from the database first.
+    """
+    path = snapshotPath(dbPath)
+    version = catalog_version()
+    snapshot = MediaCatalog.fromSnapshot(path, root)
+    if snapshot is not None and snapshot[1] == version:
+        return snapshot[0]
+
+    print('Building catalog snapshot')
+    catalog = loadCatalog(root)
+    try:
+        catalog.save(path, version)
+    except OSError as e:
+        print(f'Cannot write catalog snapshot {path}: {e}')
+        return catalog
+    snapshot = MediaCatalog.fromSnapshot(path, root)
+    return catalog if snapshot is None else snapshot[0]
+
+
+def loadCatalog(root: str) -> MediaCatalog:
+    """Catalog of media with at least one path, paths relative to root"""
+    mediaRows = (
+        db.session.query(
+            Media.hash,
+            Media.aspectratio,
+            Media.video,
+            Media.duration,
+            Media.rotation,
+            Media.width,
+            Media.height,
+            Media.size,
+            # Undated media sorts last
+            sqlfunc.coalesce(Media.datetime, 0)
+        )
+        .filter(exists().where(MediaPath.hash == Media.hash))
+        .order_by(Media.hash)
+        .yield_per(LOAD_BATCH_SIZE)
+    )
+    pathRows = (
+        db.session.query(
+            MediaPath.path,
+            MediaPath.hash,
+            MediaPath.extension,
+            ScanEntry.mtime
+        )
+        .outerjoin(ScanEntry, ScanEntry.path == MediaPath.path)
+        .order_by(MediaPath.path)
+        .yield_per(LOAD_BATCH_SIZE)
+    )
+    return MediaCatalog.build(root, mediaRows, pathRows)
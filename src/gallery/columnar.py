@@ -0,0 +1,76 @@
+from array import array
+from struct import pack
+from sys import byteorder
+
+MAGIC = b'SGC1'
+
+# Columnar media listing, little-endian:
+#   magic, uint32 count, uint32 directory count, uint32 reserved
+#   float64 size[count]
+#   float32 aspectRatio[count]
+#   uint32 width[count], uint32 height[count], uint32 directory[count]
+#   int16 rotation[count]
+#   uint8 video[count], uint8 hash length[count]
+#   padding to 4 bytes
+#   then blobs, each prefixed by uint32 byte length:
+#   raw hash digests, NUL separated directories, names and durations,
+#   and the cursor of the next page, empty on the last
+# Fixed width columns come first and largest first so each is aligned
+# for typed array views.
+
+
+def packColumns(*columns) -> bytes:
+    data = bytearray()
+    for column in columns:
+        if byteorder == 'big':
+            column.byteswap()
+        data += column.tobytes()
+    return bytes(data)
+
+
+def packBlob(data: bytes) -> bytes:
+    return pack('<I', len(data)) + data
+
+
+def packColumnar(items, nextCursor: str = None) -> bytes:
+    """Pack (hash, info) items of /api/media into the columnar format"""
+    sizes, ratios = array('d'), array('f')
+    widths, heights, dirIndex = array('I'), array('I'), array('I')
+    rotations = array('h')
+    videos, hashLengths = array('B'), array('B')
+    hashes = bytearray()
+    dirs, names, durations = {}, [], []
+
+    for hash, info in items:
+        digest = bytes.fromhex(hash)
+        hashes += digest
+        hashLengths.append(len(digest))
+
+        sizes.append(info['size'])
+        ratios.append(info['aspectRatio'])
+        widths.append(info['width'])
+        heights.append(info['height'])
+        rotations.append(info['rotation'] or 0)
+        videos.append(info['video'])
+
+        # Directories are dictionary encoded
+        dir, _, name = info['path'].rpartition('/')
+        dirIndex.append(dirs.setdefault(dir, len(dirs)))
+        names.append(name)
+        durations.append(info['duration'] or '')
+
+    data = MAGIC + pack('<III', len(names), len(dirs), 0) + packColumns(
+        sizes, ratios, widths, heights, dirIndex, rotations,
+        videos, hashLengths
+    )
+    data += bytes(-len(data) % 4)
+
+    return data + b''.join(
+        packBlob(blob) for blob in (
+            bytes(hashes),
+            '\0'.join(dirs).encode(),
+            '\0'.join(names).encode(),
+            '\0'.join(durations).encode(),
+            (nextCursor or '').encode()
+        )
+    )
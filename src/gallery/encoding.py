@@ -0,0 +1,65 @@
+import gzip
+from flask import request as frequest, Response
+
+# Optional, smaller than gzip for text
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def acceptedEncoding() -> str:
+    """Best content coding the client accepts"""
+    if brotli is not None and frequest.accept_encodings['br'] > 0:
+        return 'br'
+    if frequest.accept_encodings['gzip'] > 0:
+        return 'gzip'
+    return 'identity'
+
+
+def compress(body: bytes, encoding: str) -> (bytes, str):
+    """Body compressed with encoding, and the encoding actually used"""
+    if len(body) < COMPRESS_MIN_SIZE:
+        return (body, 'identity')
+    if encoding == 'br':
+        return (brotli.compress(body, quality=BROTLI_QUALITY), encoding)
+    if encoding == 'gzip':
+        # Fixed mtime keeps output identical for the same body
+        return (
+            gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0),
+            encoding
+        )
+    return (body, 'identity')
+
+
+def notModified(etag: str) -> bool:
+    return etag in frequest.if_none_match
+
+
+def encodedResponse(
+    body: bytes,
+    mimetype: str,
+    etag: str,
+    encoding: str = 'identity'
+) -> Response:
+    """Response revalidated by etag on every use"""
+    resp = Response(body, mimetype=mimetype)
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.vary.add('Accept-Encoding')
+    if encoding != 'identity':
+        resp.headers['Content-Encoding'] = encoding
+    return resp
+
+
+def notModifiedResponse(etag: str) -> Response:
+    resp = Response(status=304)
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.vary.add('Accept-Encoding')
+    return resp
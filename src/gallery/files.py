@@ -0,0 +1,185 @@
+from os import stat
+from mimetypes import guess_type as guessMimetype
+from secrets import token_hex
+from datetime import datetime, timezone
+from flask import request as frequest, Response
+from werkzeug.wsgi import wrap_file
+
+# Read size when streaming from Python
+BUFFER_SIZE = 256 * 1024
+# More ranges than this are answered with the whole file
+MAX_RANGES = 16
+
+
+def fileValidators(
+    path: str,
+    size: int = None,
+    mtime: int = None
+) -> (int, str, datetime):
+    """
+    Size, strong ETag and last modified time of a file. Known size and
+    mtime in nanoseconds skip the stat.
+    """
+    if size is None or mtime is None:
+        fstat = stat(path)
+        size, mtime = fstat.st_size, fstat.st_mtime_ns
+    return (
+        size,
+        f'{size:x}-{mtime:x}',
+        datetime.fromtimestamp(mtime // 1000000000, timezone.utc)
+    )
+
+
+def readRange(f, start: int, length: int, buffer: bytearray = None):
+    """Yield length bytes of f from start, reading into a reused buffer"""
+    buffer = buffer or bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    f.seek(start)
+    while length > 0:
+        n = f.readinto(view[:min(length, len(buffer))])
+        if not n:
+            break
+        length -= n
+        yield bytes(view[:n])
+
+
+def requestedRanges(size: int, etag: str, modified: datetime) -> list | None:
+    """
+    Byte ranges to send as (start, end) with end exclusive, None for the
+    whole file, or an empty list if no range can be satisfied.
+    """
+    ranges = frequest.range
+    # Absent, malformed or unit other than bytes
+    if ranges is None or ranges.units != 'bytes':
+        return None
+
+    # Client's copy is outdated; send all of it
+    ifRange = frequest.if_range
+    if ifRange.etag is not None and ifRange.etag != etag:
+        return None
+    if ifRange.date is not None and ifRange.date != modified:
+        return None
+
+    if len(ranges.ranges) > MAX_RANGES:
+        return None
+
+    satisfiable = []
+    for start, end in ranges.ranges:
+        # Suffix range; last bytes of the file
+        if start < 0:
+            start, end = max(size + start, 0), size
+        end = size if end is None else min(end, size)
+        if start < end:
+            satisfiable.append((start, end))
+    return satisfiable
+
+
+def multipartRanges(
+    path: str,
+    ranges: list,
+    size: int,
+    mimetype: str,
+    boundary: str
+) -> (int, object):
+    """Content length and body generator of a multipart/byteranges reply"""
+    headers = [
+        (
+            f'\r\n--{boundary}\r\n'
+            f'Content-Type: {mimetype}\r\n'
+            f'Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n'
+        ).encode()
+        for start, end in ranges
+    ]
+    closing = f'\r\n--{boundary}--\r\n'.encode()
+    length = sum(map(len, headers)) + len(closing) + sum(
+        end - start for start, end in ranges
+    )
+
+    def generate():
+        buffer = bytearray(BUFFER_SIZE)
+        with open(path, 'rb') as f:
+            for header, (start, end) in zip(headers, ranges):
+                yield header
+                yield from readRange(f, start, end - start, buffer)
+        yield closing
+
+    return (length, generate())
+
+
+def sendFile(
+    path: str,
+    mimetype: str = None,
+    size: int = None,
+    mtime: int = None
+) -> Response:
+    """
+    Send a file with ETag and Last-Modified validators and byte ranges,
+    including suffix and multiple ranges. Whole files and single ranges
+    are handed to the server's file wrapper, which can use sendfile.
+    """
+    size, etag, modified = fileValidators(path, size, mtime)
+    mimetype = (
+        mimetype or guessMimetype(path)[0] or 'application/octet-stream'
+    )
+    environ = frequest.environ
+
+    if etag in frequest.if_none_match or (
+        not frequest.if_none_match and
+        frequest.if_modified_since is not None and
+        modified <= frequest.if_modified_since
+    ):
+        resp = Response(status=304)
+    else:
+        ranges = requestedRanges(size, etag, modified)
+        if ranges == []:
+            resp = Response(status=416)
+            resp.headers['Content-Range'] = f'bytes */{size}'
+        elif ranges is None:
+            resp = Response(
+                wrap_file(environ, open(path, 'rb'), BUFFER_SIZE),
+                mimetype=mimetype,
+                direct_passthrough=True
+            )
+            resp.content_length = size
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            f = open(path, 'rb')
+            if 'wsgi.file_wrapper' in environ:
+                # Server sends from the current offset up to Content-Length
+                f.seek(start)
+                body = environ['wsgi.file_wrapper'](f, BUFFER_SIZE)
+            else:
+                body = closingIter(readRange(f, start, end - start), f)
+            resp = Response(
+                body,
+                status=206,
+                mimetype=mimetype,
+                direct_passthrough=True
+            )
+            resp.content_length = end - start
+            resp.headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        else:
+            boundary = token_hex(16)
+            length, body = multipartRanges(
+                path, ranges, size, mimetype, boundary
+            )
+            resp = Response(
+                body,
+                status=206,
+                mimetype=f'multipart/byteranges; boundary={boundary}',
+                direct_passthrough=True
+            )
+            resp.content_length = length
+
+    resp.set_etag(etag)
+    resp.last_modified = modified
+    resp.headers['Accept-Ranges'] = 'bytes'
+    return resp
+
+
+def closingIter(iterable, f):
+    """Close f once iterable is exhausted or the response is closed"""
+    try:
+        yield from iterable
+    finally:
+        f.close()
@@ -0,0 +1,285 @@
+from os.path import join as pathJoin, exists
+from os import cpu_count, stat
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
+from queue import Queue
+from threading import Thread
+from functools import partial
+from typing import NamedTuple
+from media.metadataExtract import MetaExtract
+from media.thumbnails import ImgThumbnails, VidThumbnails
+from media.mediatype import MediaType, GetMediaType
+from utils.filehash import HashFile, QuickHashFile, FullAlgorithm
+from utils.filehash import DEFAULT_ALGORITHM, QUICK_PREFIX
+
+# Files handed to the pool but not yet collected, per worker
+PENDING_PER_WORKER = 4
+# Scanned files buffered ahead of processing
+SCAN_QUEUE_SIZE = 1024
+# Workers are started while the scan thread runs; forking then could copy
+# a lock it holds, such as stdout's
+POOL_CONTEXT = 'forkserver'
+
+
+class ThumbnailOptions(NamedTuple):
+    dir: str
+    sizes: list[int]
+    # jpg is always generated as fallback
+    formats: list[str] = ['jpg']
+    # Encoder quality by format
+    quality: dict = {}
+
+
+def thumbnailPath(hash: str, size: int, ext: str = 'jpg') -> (str, str):
+    return (
+        f'{hash[:2]}/{hash[2:4]}/',
+        f'{hash[4:]}-{size}.{ext}'
+    )
+
+
+def missingThumbnails(hash: str, thumbnails: ThumbnailOptions) -> dict:
+    """Map of size to thumbnail paths not yet generated"""
+    missing = {}
+    for tSize in thumbnails.sizes:
+        for ext in thumbnails.formats:
+            tpath = pathJoin(
+                thumbnails.dir,
+                ''.join(thumbnailPath(hash, tSize, ext))
+            )
+            if not exists(tpath):
+                missing.setdefault(tSize, []).append(tpath)
+    return missing
+
+
+def thumbnailsExist(hash: str, thumbnails: ThumbnailOptions) -> bool:
+    return not missingThumbnails(hash, thumbnails)
+
+
+def generateThumbnails(
+    mediaPath: str,
+    hash: str,
+    thumbnails: ThumbnailOptions,
+    duration: str = None
+):
+    missing = missingThumbnails(hash, thumbnails)
+    if not missing:
+        return
+
+    print(f"Generating thumbnails for {hash} from {mediaPath}")
+    mtype = GetMediaType(mediaPath)
+    if mtype == MediaType.IMAGE:
+        # All sizes from one decode
+        ImgThumbnails(mediaPath, missing, thumbnails.quality)
+    elif mtype == MediaType.VIDEO:
+        # All sizes from one ffmpeg run
+        VidThumbnails(mediaPath, missing, duration, thumbnails.quality)
+
+
+def processMedia(
+    mediaPath: str,
+    thumbnails: ThumbnailOptions,
+    hashAlgorithm: str = DEFAULT_ALGORITHM,
+    hashMmap: bool = False,
+    quickHash: bool = False
+) -> (str, dict):
+    """Extract metadata, hash and generate thumbnails for a single file"""
+    # Stat before reading so later changes are picked up by the next scan
+    try:
+        fstat = stat(mediaPath)
+    except OSError as e:
+        # Dangling symlink or deleted since listing
+        print(f"Cannot stat {mediaPath}: {e}")
+        return (mediaPath, None)
+
+    metadata = MetaExtract(mediaPath)
+    # Not supported; skip
+    if metadata is None:
+        print(f"Cannot extract metadata from {mediaPath}")
+        return (mediaPath, None)
+
+    try:
+        if quickHash:
+            hash, hashAlgorithm = QuickHashFile(
+                mediaPath, hashAlgorithm, useMmap=hashMmap
+            )
+        else:
+            hash = HashFile(mediaPath, hashAlgorithm, useMmap=hashMmap)
+    except OSError as e:
+        print(f"Cannot hash {mediaPath}: {e}")
+        return (mediaPath, None)
+    metadata['hash'] = hash
+    metadata['hashalgorithm'] = hashAlgorithm
+    metadata['aspectratio'] = metadata['width'] / metadata['height']
+    metadata['mtime'] = fstat.st_mtime_ns
+    metadata['inode'] = fstat.st_ino
+
+    generateThumbnails(
+        mediaPath, hash, thumbnails, duration=metadata.get('duration')
+    )
+
+    return (mediaPath, metadata)
+
+
+def resolveQuickCollisions(
+    results,
+    knownQuick: dict,
+    manifest: dict,
+    resolvePath,
+    thumbnails: ThumbnailOptions,
+    hashMmap: bool = False
+):
+    """
+    Compare full hashes when a quick hash is already used by another file.
+    Duplicates keep the quick hash, distinct files are keyed by full hash.
+    knownQuick maps quick hash to [stored path, full hash or None].
+    """
+    for mediaPath, row in results:
+        algorithm = row['hashalgorithm']
+        if row['moved'] or not algorithm.startswith(QUICK_PREFIX):
+            yield (mediaPath, row)
+            continue
+
+        known = knownQuick.setdefault(row['hash'], [row['path'], None])
+        previous = manifest.get(row['path'])
+        # Same file as before
+        if known[0] == row['path'] or (
+            previous is not None and previous[3] == row['hash']
+        ):
+            yield (mediaPath, row)
+            continue
+
+        print(f"Quick hash collision, verifying {mediaPath}")
+        algorithm = FullAlgorithm(algorithm)
+        fullHash = HashFile(mediaPath, algorithm, useMmap=hashMmap)
+        if known[1] is None:
+            try:
+                known[1] = HashFile(
+                    resolvePath(known[0]), algorithm, useMmap=hashMmap
+                )
+            except FileNotFoundError:
+                pass
+
+        if fullHash == known[1]:
+            row['fullhash'] = fullHash
+        else:
+            # Different content; key by full hash instead
+            row['hash'] = fullHash
+            row['hashalgorithm'] = algorithm
+            generateThumbnails(
+                mediaPath, fullHash, thumbnails, duration=row['duration']
+            )
+        yield (mediaPath, row)
+
+
+def prefetch(iterable, maxsize: int):
+    """Run iterable in a background thread, buffering at most maxsize items"""
+    buffer = Queue(maxsize)
+    end = object()
+    error = None
+
+    def producer():
+        nonlocal error
+        try:
+            for item in iterable:
+                buffer.put(item)
+        except Exception as e:
+            error = e
+        finally:
+            buffer.put(end)
+
+    Thread(target=producer, daemon=True).start()
+
+    while (item := buffer.get()) is not end:
+        yield item
+
+    if error is not None:
+        raise error
+
+
+def processAll(
+    tasks,
+    thumbnails: ThumbnailOptions,
+    workers: int = 1,
+    hashAlgorithm: str = DEFAULT_ALGORITHM,
+    hashMmap: bool = False,
+    quickHash: bool = False
+):
+    """
+    Yield (path, metadata) for every (path, metadata) task, in order of
+    completion. Tasks without metadata are processed, in a process pool
+    when workers > 1, with a bounded number of files in flight.
+    """
+    process = partial(
+        processMedia,
+        thumbnails=thumbnails,
+        hashAlgorithm=hashAlgorithm,
+        hashMmap=hashMmap,
+        quickHash=quickHash
+    )
+
+    # Use all cores
+    if workers <= 0:
+        workers = cpu_count() or 1
+
+    if workers == 1:
+        for mediaPath, metadata in tasks:
+            if metadata is not None:
+                yield (mediaPath, metadata)
+            else:
+                yield process(mediaPath)
+        return
+
+    maxPending = workers * PENDING_PER_WORKER
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=get_context(POOL_CONTEXT)
+    ) as executor:
+        pending = set()
+        for mediaPath, metadata in tasks:
+            # Already known; pass through
+            if metadata is not None:
+                yield (mediaPath, metadata)
+                continue
+
+            pending.add(executor.submit(process, mediaPath))
+
+            # Wait for any file to finish before handing out more
+            if len(pending) >= maxPending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+        for future in as_completed(pending):
+            yield future.result()
+
+
+def generateThumbnailTask(task: tuple, thumbnails: ThumbnailOptions):
+    mediaPath, hash, duration = task
+    try:
+        generateThumbnails(mediaPath, hash, thumbnails, duration=duration)
+    except Exception as e:
+        print(f"Failed to generate thumbnails for {mediaPath}: {e}")
+
+
+def generateAll(tasks, thumbnails: ThumbnailOptions, workers: int = 1):
+    """
+    Generate missing thumbnails of (path, hash, duration) tasks for files
+    already indexed, without extracting metadata or hashing
+    """
+    generate = partial(generateThumbnailTask, thumbnails=thumbnails)
+
+    # Use all cores
+    if workers <= 0:
+        workers = cpu_count() or 1
+
+    if workers == 1:
+        for task in tasks:
+            generate(task)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=get_context(POOL_CONTEXT)
+    ) as executor:
+        # Surfaces pool failures such as a killed worker
+        for _ in executor.map(generate, tasks, chunksize=PENDING_PER_WORKER):
+            pass
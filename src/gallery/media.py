@@ -1,14 +1,59 @@
 from models.models import Media, MediaPath, MediaTag
-from sqlalchemy import func as sqlfunc, or_, select
+from sqlalchemy import func as sqlfunc, and_, or_, exists, select
 from models import db
+from typing import NamedTuple
+from sys import maxunicode
+
+
+class MediaRecord(NamedTuple):
+    """In-memory record of a media file used to serve it"""
+    # Absolute path of the original
+    original: str
+    size: int
+    video: bool
+    # Modification time in nanoseconds, None if not in the scan manifest
+    mtime: int | None = None
+    duration: str = None
+    rotation: int = None
+
+
+# Orderings accepted by getMediaInfo
+SORT_ORDERS = ('path', 'datetime')
+
+
+def prefixUpperBound(prefix: str) -> str | None:
+    """
+    Smallest string greater than every string starting with prefix, None
+    if there is none
+    """
+    # Highest code point cannot be incremented; carry into the previous
+    prefix = prefix.rstrip(chr(maxunicode))
+    if not prefix:
+        return None
+    code = ord(prefix[-1]) + 1
+    # Surrogates cannot be encoded to UTF-8 for SQLite
+    if 0xD800 <= code <= 0xDFFF:
+        code = 0xE000
+    return prefix[:-1] + chr(code)
 
 
 def getMediaInfo(
     pathFilter: str = None,
     tagsFilter: list = None,
     itagsFilter: list = None,
-    typeFilter: list = None
+    typeFilter: list = None,
+    sort: str = 'path',
+    after: list = None,
+    limit: int = None,
+    yieldPer: int = None
 ):
+    """
+    Media rows ordered by path, or newest first by datetime with path as
+    tiebreaker. after is the sort key of the last row of the previous page.
+    With yieldPer, returns an iterator fetching that many rows at a time.
+    """
+    # Undated media sorts last
+    mediaTime = sqlfunc.coalesce(Media.datetime, 0)
     rows = db.session.query(
         Media.hash,
         MediaPath.path,
@@ -18,13 +63,17 @@ def getMediaInfo(
         Media.rotation,
         Media.width,
         Media.height,
-        Media.size
+        Media.size,
+        mediaTime,
+        MediaPath.extension
     ).join(MediaPath.media)
 
-    if pathFilter is not None:
-        rows = rows.filter(
-            MediaPath.path.like(pathFilter)
-        )
+    # Prefix as a primary key range
+    if pathFilter:
+        rows = rows.filter(MediaPath.path >= pathFilter)
+        upperBound = prefixUpperBound(pathFilter)
+        if upperBound is not None:
+            rows = rows.filter(MediaPath.path < upperBound)
 
     if typeFilter is not None and len(typeFilter) > 0:
         conditions = []
@@ -35,42 +84,57 @@ def getMediaInfo(
             conditions.append(Media.video.is_(False))
 
         # Filter extensions / mimetypes
-        mediaExts = [t for t in typeFilter if t not in ("video", "image")]
+        mediaExts = [
+            t.lower() for t in typeFilter if t not in ("video", "image")
+        ]
         if mediaExts:
-            ext_conditions = [
-                MediaPath.path.like(f"%.{ext}") for ext in mediaExts
-            ]
-            conditions.append(or_(*ext_conditions))
+            conditions.append(MediaPath.extension.in_(mediaExts))
 
         if conditions:
             rows = rows.filter(or_(*conditions))
 
-    if tagsFilter is not None and len(tagsFilter) > 0:
-        rows = (
-            rows
-            .join(MediaTag, Media.hash == MediaTag.hash)
-            # Match ANY tag in filter
-            .filter(MediaTag.tag.in_(tagsFilter))
-            # Match ALL tags in filter
-            .group_by(MediaTag.hash)
-            # Count number of tag matches for hash
-            .having(
-                sqlfunc.count(
-                    sqlfunc.distinct(MediaTag.tag)
-                ) == len(tagsFilter)
+    # Match ALL tags in filter; driven by the tag index
+    for tag in set(tagsFilter or []):
+        rows = rows.filter(
+            MediaPath.hash.in_(
+                select(MediaTag.hash).where(MediaTag.tag == tag)
             )
         )
 
     # Exclude media with any tags in itagsFilter
-    if itagsFilter is not None and len(itagsFilter) > 0:
+    if itagsFilter:
         rows = rows.filter(
-            ~Media.hash.in_(
-                select(
-                    rows.session.query(MediaTag.hash)
-                    .filter(MediaTag.tag.in_(itagsFilter))
-                    .subquery()
-                )
+            ~exists().where(
+                MediaTag.hash == MediaPath.hash,
+                MediaTag.tag.in_(itagsFilter)
             )
         )
 
-    return rows.order_by(MediaPath.path).all()
+    # Keyset pagination; rows strictly after the previous page
+    if sort == 'datetime':
+        if after is not None:
+            rows = rows.filter(or_(
+                mediaTime < after[0],
+                and_(mediaTime == after[0], MediaPath.path > after[1])
+            ))
+        rows = rows.order_by(mediaTime.desc(), MediaPath.path)
+    else:
+        if after is not None:
+            rows = rows.filter(MediaPath.path > after[0])
+        rows = rows.order_by(MediaPath.path)
+
+    if limit is not None:
+        rows = rows.limit(limit)
+
+    if yieldPer is not None:
+        return iter(rows.yield_per(yieldPer))
+    return rows.all()
+
+
+def getTagRows():
+    """(hash, tag) rows in hash order, as the media index reads them"""
+    return (
+        db.session.query(MediaTag.hash, MediaTag.tag)
+        .order_by(MediaTag.hash)
+        .all()
+    )
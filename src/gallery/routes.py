@@ -1,16 +1,37 @@
-from flask import Blueprint, render_template, send_from_directory, send_file
+from flask import Blueprint, render_template, send_from_directory
 from flask import abort, request as frequest, make_response, jsonify
-from flask import current_app, Response
-from os.path import isabs, join as pathJoin, basename, abspath
+from flask import current_app, Response, stream_with_context
+from os.path import join as pathJoin, basename, abspath, exists
+from os.path import isfile, splitext
+from os import stat
+from mimetypes import guess_type as guessMimetype
+from werkzeug.utils import safe_join
 from models.models import Media, MediaTag
-from models import db
-from sqlalchemy import distinct
-from gallery.media import getMediaInfo
+from models import db, bump_catalog_version
+from sqlalchemy import distinct, update
+from sqlalchemy.dialects.sqlite import insert as sqliteInsert
+from gallery.media import getMediaInfo, getTagRows, SORT_ORDERS
+from gallery.columnar import packColumnar
+from gallery.encoding import acceptedEncoding, compress, notModified
+from gallery.encoding import encodedResponse, notModifiedResponse
+from gallery.files import sendFile
+from gallery.indexer import thumbnailPath
+from gallery.bitmap import MediaIndex
+from gallery.catalog import openCatalog
 from functools import wraps
 from collections import OrderedDict
-from re import match as reMatch
+from concurrent.futures import Future
+from threading import Lock
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from struct import pack
+from hashlib import sha1
+import json
 
 bp = Blueprint('main_routes', __name__)
+# Held while mapping a rewritten catalog snapshot
+CATALOG_LOCK = Lock()
+# Hashes per statement, below SQLite's variable limit
+CHUNK_SIZE = 500
 
 
 # Decorator for cache control
@@ -37,155 +58,434 @@ def lightbox(hash):
     return render_template('gallery.html')
 
 
+# Static files compressed on the fly, by extension
+COMPRESSIBLE_EXTS = {'.js', '.css', '.html', '.svg', '.json'}
+# (path, encoding) -> (etag, body, encoding used)
+STATIC_CACHE = {}
+
+
 @bp.route('/static/<path:filename>')
 def serve_static(filename):
-    return send_from_directory(
-        pathJoin(current_app.root_path, '../static'), filename
+    staticDir = pathJoin(current_app.root_path, '../static')
+    encoding = acceptedEncoding()
+    if (
+        encoding == 'identity' or
+        splitext(filename)[1] not in COMPRESSIBLE_EXTS
+    ):
+        return send_from_directory(staticDir, filename)
+
+    path = safe_join(staticDir, filename)
+    if path is None or not isfile(path):
+        abort(404)
+
+    # Changes with the file
+    fstat = stat(path)
+    etag = f'{fstat.st_mtime_ns:x}-{fstat.st_size:x}-{encoding}'
+    if notModified(etag):
+        return notModifiedResponse(etag)
+
+    cached = STATIC_CACHE.get((path, encoding))
+    if cached is None or cached[0] != etag:
+        with open(path, 'rb') as f:
+            body, used = compress(f.read(), encoding)
+        cached = STATIC_CACHE[(path, encoding)] = (etag, body, used)
+
+    return encodedResponse(
+        cached[1],
+        guessMimetype(path)[0] or 'application/octet-stream',
+        etag,
+        cached[2]
     )
 
 
+# Largest page returned by /api/media
+MAX_PAGE_SIZE = 10000
+# Rows fetched from the database at a time when streaming
+STREAM_BATCH_SIZE = 1000
+# Cacheable formats of /api/media
+MEDIA_MIMETYPES = {
+    'json': 'application/json',
+    'columnar': 'application/octet-stream',
+}
+
+
+def encodeCursor(key: list) -> str:
+    return urlsafe_b64encode(
+        json.dumps(key, separators=(',', ':')).encode()
+    ).decode()
+
+
+def decodeCursor(cursor: str, sort: str) -> list:
+    key = json.loads(urlsafe_b64decode(cursor.encode()))
+    # Datetime keys are [datetime, path], path keys are [path]
+    types = ((int, float), str) if sort == 'datetime' else (str,)
+    if (
+        type(key) is not list or
+        len(key) != len(types) or
+        any(
+            isinstance(value, bool) or not isinstance(value, valueType)
+            for value, valueType in zip(key, types)
+        )
+    ):
+        raise ValueError(f"Cursor does not match sort '{sort}'")
+    return key
+
+
+def mediaItem(row) -> (str, dict):
+    return (row[0], {
+        'name': basename(row[1]),
+        'aspectRatio': row[2],
+        'video': row[3],
+        'duration': row[4],
+        'rotation': row[5],
+        'width': row[6],
+        'height': row[7],
+        'path': row[1],
+        'size': row[8]
+    })
+
+
+def streamMediaInfo(rows):
+    """One JSON [hash, info] line per row as rows are fetched"""
+    for row in rows:
+        yield json.dumps(mediaItem(row), separators=(',', ':')) + '\n'
+
+
 @bp.route('/api/media')
 def get_mediaInfo():
-    """API endpoint to get all images with their aspect ratios"""
+    """
+    API endpoint to get images with their aspect ratios. With limit, returns
+    one page and a cursor for the next in next. format=ndjson streams one
+    [hash, info] line per path instead, format=columnar packs the listing
+    as described in gallery.columnar.
+    """
     pathFilter = frequest.args.get('path', default=None)
     tagsFilter = frequest.args.getlist('tag')
     itagsFilter = frequest.args.getlist('itag')
     typeFilter = frequest.args.get('types', default='').split(',')
+    sort = frequest.args.get('sort', default='path')
+    limit = frequest.args.get('limit', default=None, type=int)
+    cursor = frequest.args.get('cursor', default=None)
+    outFormat = frequest.args.get('format', default='json')
     cacheKey = (
         pathFilter,
         frozenset(tagsFilter),
         frozenset(itagsFilter),
-        frozenset(typeFilter)
+        frozenset(typeFilter),
+        sort,
+        limit,
+        cursor,
+        outFormat
     )
     if typeFilter == ['']:
         typeFilter = None
 
-    if pathFilter is not None:
-        pathFilter = f"{pathFilter}%"
+    if sort not in SORT_ORDERS:
+        return jsonify({
+            'success': False,
+            'msg': f"Sort must be one of {', '.join(SORT_ORDERS)}"
+        }), 400
+
+    if limit is not None:
+        if limit <= 0:
+            return jsonify({
+                'success': False,
+                'msg': "Limit must be a positive integer"
+            }), 400
+        limit = min(limit, MAX_PAGE_SIZE)
+
+    after = None
+    if cursor is not None:
+        try:
+            after = decodeCursor(cursor, sort)
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'msg': f"Invalid cursor: {e}"
+            }), 400
+
+    if outFormat == 'ndjson':
+        rows = getMediaInfo(
+            pathFilter=pathFilter,
+            tagsFilter=tagsFilter,
+            itagsFilter=itagsFilter,
+            typeFilter=typeFilter,
+            sort=sort,
+            after=after,
+            limit=limit,
+            yieldPer=STREAM_BATCH_SIZE
+        )
+        # Not cached; bodies are never held whole in memory
+        return Response(
+            stream_with_context(streamMediaInfo(rows)),
+            mimetype='application/x-ndjson'
+        )
+    elif outFormat not in MEDIA_MIMETYPES:
+        return jsonify({
+            'success': False,
+            'msg': "Format must be json, ndjson or columnar"
+        }), 400
 
-    if cacheKey in current_app.config['media_cache']:
-        return current_app.config['media_cache'][cacheKey]
+    refreshCatalog()
+    cache = current_app.config['media_cache']
+    encoding = acceptedEncoding()
+    cacheKey += (encoding,)
+    version = cache.version
+    etag = cache.etag(sorted(frequest.args.items(multi=True)), encoding)
+    # Library unchanged since the client's copy
+    if notModified(etag):
+        return notModifiedResponse(etag)
+
+    cached = cache.get(cacheKey)
+    if cached is not None:
+        return encodedResponse(
+            cached[0], MEDIA_MIMETYPES[outFormat], etag, cached[1]
+        )
 
-    # Get media list from database
-    rows = getMediaInfo(
+    # One extra row tells if more remain
+    rows = mediaIndex().query(
         pathFilter=pathFilter,
         tagsFilter=tagsFilter,
         itagsFilter=itagsFilter,
-        typeFilter=typeFilter
+        typeFilter=typeFilter,
+        sort=sort,
+        after=after,
+        limit=None if limit is None else limit + 1
     )
 
-    mediaInfo = OrderedDict()
-    for row in rows:
-        mediaInfo[row[0]] = {
-            'name': basename(row[1]),
-            'aspectRatio': row[2],
-            'video': row[3],
-            'duration': row[4],
-            'rotation': row[5],
-            'width': row[6],
-            'height': row[7],
-            'path': row[1],
-            'size': row[8]
-        }
-
-    resp = {
+    nextCursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        nextCursor = encodeCursor(
+            [last[9], last[1]] if sort == 'datetime' else [last[1]]
+        )
+
+    mediaInfo = OrderedDict(mediaItem(row) for row in rows)
+
+    if outFormat == 'columnar':
+        body = packColumnar(mediaInfo.items(), nextCursor)
+    else:
+        body = jsonify({
+            'success': True,
+            'data': list(mediaInfo.items()),
+            'next': nextCursor
+        }).get_data()
+
+    # Compressed once and cached compressed
+    body, encoding = compress(body, encoding)
+    # Tag writes only invalidate entries filtering on those tags
+    cache.put(
+        cacheKey,
+        body,
+        encoding,
+        tags=frozenset(tagsFilter) | frozenset(itagsFilter),
+        version=version
+    )
+    return encodedResponse(body, MEDIA_MIMETYPES[outFormat], etag, encoding)
+
+
+@bp.route('/api/cache')
+def get_cacheStats():
+    return jsonify({
         'success': True,
-        'data': list(mediaInfo.items())
-    }
-    current_app.config['media_cache'][cacheKey] = jsonify(resp)
-    return current_app.config['media_cache'][cacheKey]
+        'data': current_app.config['media_cache'].stats()
+    })
+
+
+# Preferred order of thumbnail formats, jpg is the fallback
+THUMBNAIL_MIMETYPES = {
+    'avif': 'image/avif',
+    'webp': 'image/webp',
+}
+# Seconds to wait for an on-demand thumbnail
+THUMBNAIL_TIMEOUT = 30
+
+
+def queueThumbnails(hash: str) -> Future | None:
+    record = current_app.config['mediaCatalog'][hash]
+    return current_app.config['thumbnailQueue'].request(
+        hash, record.original, record.duration
+    )
+
+
+def thumbnailFilename(hash: str, tsize: int) -> (str, bool):
+    """
+    Best generated thumbnail variant the client accepts, and whether it is
+    the best variant it will get
+    """
+    # Wildcards do not count; browsers list supported formats explicitly
+    accepted = {mime for mime, q in frequest.accept_mimetypes if q > 0}
+    best = True
+    for ext, mimetype in THUMBNAIL_MIMETYPES.items():
+        if (
+            ext not in current_app.config['thumbnailFormats'] or
+            mimetype not in accepted
+        ):
+            continue
+        filename = ''.join(thumbnailPath(hash, tsize, ext))
+        if exists(pathJoin(current_app.config['thumbnailDir'], filename)):
+            return (filename, best)
+        # Generate in background, serve fallback meanwhile
+        queueThumbnails(hash)
+        best = False
+    return (''.join(thumbnailPath(hash, tsize)), best)
+
+
+def sendThumbnail(hash: str, tsize: int):
+    thumbnailDir = abspath(current_app.config['thumbnailDir'])
+    filename, best = thumbnailFilename(hash, tsize)
+
+    # Not generated yet; render on demand
+    if not exists(pathJoin(thumbnailDir, filename)):
+        future = queueThumbnails(hash)
+        try:
+            if future is None:
+                raise TimeoutError
+            future.result(timeout=THUMBNAIL_TIMEOUT)
+        except TimeoutError:
+            abort(Response(
+                'Thumbnail generation busy', 503, {'Retry-After': '5'}
+            ))
+        except Exception as e:
+            print(f'Failed to generate thumbnail for {hash}: {e}')
+            abort(404)
+        filename, best = thumbnailFilename(hash, tsize)
+
+    resp = send_from_directory(thumbnailDir, filename)
+    # Fallbacks are revalidated so the preferred format replaces them
+    resp.headers['Cache-Control'] = (
+        'public, max-age=86400' if best else 'no-cache'
+    )
+    # Format depends on Accept header
+    resp.headers['Vary'] = 'Accept'
+    return resp
 
 
 @bp.route('/media/<hash>/thumbnail/<tsize>')
-@cacheControl()
 def serve_sized_thumbnail(hash, tsize):
     try:
         tsize = int(tsize)
     except ValueError:
         abort(404)
     if (
-        hash not in current_app.config['mediaPath'] or
+        hash not in current_app.config['mediaCatalog'] or
         tsize not in current_app.config['thumbnailSizes']
     ):
         abort(404)
-    return send_from_directory(
-        abspath(current_app.config['thumbnailDir']),
-        current_app.config['mediaPath'][hash]['thumbnailPrefix'] +
-        f"-{tsize}.jpg"
-    )
+    return sendThumbnail(hash, tsize)
 
 
 @bp.route('/media/<hash>/thumbnail')
-@cacheControl()
 def serve_thumbnail(hash):
-    if hash not in current_app.config['mediaPath']:
+    if hash not in current_app.config['mediaCatalog']:
         abort(404)
-    return send_from_directory(
-        abspath(current_app.config['thumbnailDir']),
-        current_app.config['mediaPath'][hash]['thumbnailPrefix'] +
-        f"-{current_app.config['defaultThumbnailSize']}.jpg"
+    return sendThumbnail(hash, current_app.config['defaultThumbnailSize'])
+
+
+# Most thumbnails returned by one batch request
+MAX_BATCH_THUMBNAILS = 200
+BUNDLE_MAGIC = b'SGT1'
+
+
+def thumbnailBundle(items):
+    """
+    Length-prefixed bundle of thumbnails: magic, then per item uint8
+    length and ASCII hash, uint8 length and mimetype, uint32 length and
+    data, little-endian. Missing thumbnails have empty mimetype and data.
+    """
+    yield BUNDLE_MAGIC
+    for hash, path in items:
+        data, mimetype = b'', b''
+        if path is not None:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                mimetype = THUMBNAIL_MIMETYPES.get(
+                    splitext(path)[1][1:], 'image/jpeg'
+                ).encode()
+            except FileNotFoundError:
+                pass
+        hash = hash.encode()
+        yield (
+            pack('<B', len(hash)) + hash +
+            pack('<B', len(mimetype)) + mimetype +
+            pack('<I', len(data))
+        )
+        yield data
+
+
+@bp.route('/api/thumbnails')
+def getThumbnailBundle():
+    """
+    Thumbnails of many media in one cacheable response, hashes given comma
+    separated. Missing thumbnails are queued for generation and left empty
+    rather than waited on.
+    """
+    hashes = frequest.args.get('hashes', '')
+    hashes = hashes.split(',') if hashes else []
+    tsize = frequest.args.get(
+        'size', current_app.config['defaultThumbnailSize'], type=int
     )
+    if (
+        len(hashes) > MAX_BATCH_THUMBNAILS or
+        not all(h.isascii() and len(h) < 256 for h in hashes) or
+        tsize not in current_app.config['thumbnailSizes']
+    ):
+        return jsonify({
+            'success': False,
+            'msg': f"Expected up to {MAX_BATCH_THUMBNAILS} hashes "
+                   f"and a size in {current_app.config['thumbnailSizes']}"
+        }), 400
+
+    thumbnailDir = abspath(current_app.config['thumbnailDir'])
+    items, signature = [], []
+    complete = True
+    for hash in hashes:
+        path = None
+        if hash in current_app.config['mediaCatalog']:
+            filename, best = thumbnailFilename(hash, tsize)
+            path = pathJoin(thumbnailDir, filename)
+            complete = complete and best
+            try:
+                fstat = stat(path)
+                signature.append((
+                    hash, basename(path), fstat.st_mtime_ns, fstat.st_size
+                ))
+            except FileNotFoundError:
+                queueThumbnails(hash)
+                path = None
+        if path is None:
+            signature.append((hash, None))
+        items.append((hash, path))
+
+    # Changes with the thumbnail files, including the format picked
+    etag = sha1(repr(signature).encode()).hexdigest()
+    if notModified(etag):
+        resp = notModifiedResponse(etag)
+    else:
+        resp = Response(
+            thumbnailBundle(items), mimetype='application/octet-stream'
+        )
+        resp.set_etag(etag)
+    # Revalidate until every preferred thumbnail has been generated
+    complete = complete and all(path is not None for _, path in items)
+    resp.headers['Cache-Control'] = (
+        'public, max-age=86400' if complete else 'no-cache'
+    )
+    # Format depends on Accept header
+    resp.headers['Vary'] = 'Accept'
+    return resp
 
 
 @bp.route('/media/<hash>/original')
 @cacheControl()
 def serve_originalMedia(hash):
-    if hash not in current_app.config['mediaPath']:
+    record = current_app.config['mediaCatalog'].get(hash)
+    if record is None:
         abort(404)
 
-    original_path = current_app.config['mediaPath'][hash]['original']
-    # Path is relative
-    if not isabs(original_path):
-        original_path = pathJoin(
-            current_app.config['configDir'],
-            original_path
-        )
-
-    # If not video
-    media = Media.query.filter_by(hash=hash).first()
-    if not media or not media.video:
-        return send_file(original_path)
-
-    CHUNK_SIZE = 4 * 1024 * 1024    # 4MB
-    rangeHeader = frequest.headers.get('Range', default=None)
-
-    byteStart, byteEnd = 0, 0
-    # Default to first chunk with no range header
-    if not rangeHeader:
-        byteEnd = min(CHUNK_SIZE - 1, media.size - 1)
-    else:
-        # Parse Range header
-        range_match = reMatch(r'bytes=(\d+)-(\d*)', rangeHeader)
-        if range_match:
-            groups = range_match.groups()
-            byteStart = int(groups[0])
-            if groups[1]:
-                byteEnd = int(groups[1])
-            else:
-                byteEnd = min(byteStart + CHUNK_SIZE - 1, media.size - 1)
-        else:
-            # If Range header is malformed
-            abort(416)  # Requested Range Not Satisfiable
-
-    contentLength = byteEnd - byteStart + 1
-    with open(original_path, 'rb') as f:
-        f.seek(byteStart)
-        data = f.read(contentLength)
-
-    resp = Response(
-        data,
-        status=206,
-        mimetype='video/mp4',
-        direct_passthrough=True
-    )
-    resp.headers.add(
-        'Content-Range',
-        f'bytes {byteStart}-{byteEnd}/{media.size}'
-    )
-    resp.headers.add('Accept-Ranges', 'bytes')
-    resp.headers.add('Content-Length', str(contentLength))
-
-    return resp
+    return sendFile(record.original, size=record.size, mtime=record.mtime)
 
 
 @bp.route(
@@ -205,6 +505,7 @@ def rotateImage(hash, direction):
         }), 400
 
     media.rotation = ((media.rotation or 0) + directions[direction]) % 360
+    version = bump_catalog_version()
     success, error = safeCommit()
     if not success:
         return jsonify({
@@ -213,10 +514,11 @@ def rotateImage(hash, direction):
         }), 400
 
     # Rotate current session
-    for m in current_app.config['mediaInfo']:
-        if m['hash'] == hash:
-            m['rotation'] = media.rotation
-            break
+    current_app.config['mediaCatalog'].setRotation(
+        hash, media.rotation, version
+    )
+    # Rotation is part of every listing containing the media
+    indexUpdated(current_app.config['media_cache'].clear())
 
     return jsonify({
         "success": True,
@@ -227,6 +529,13 @@ def rotateImage(hash, direction):
 @bp.route('/api/tags', methods=['GET'])
 def getTags():
     hashFilter = frequest.args.get('hash', default=None)
+    encoding = acceptedEncoding()
+    etag = current_app.config['media_cache'].etag(
+        'tags', hashFilter, encoding
+    )
+    if notModified(etag):
+        return notModifiedResponse(etag)
+
     rows = []
     if hashFilter is None:
         # Get names of all tags
@@ -239,10 +548,51 @@ def getTags():
             .all()
         )
 
-    return jsonify({
+    body, encoding = compress(jsonify({
         'success': True,
         'data': [tag for (tag,) in rows]
-    })
+    }).get_data(), encoding)
+    return encodedResponse(body, 'application/json', etag, encoding)
+
+
+def mediaIndex() -> MediaIndex:
+    """Index of the library, reloaded if another process changed it"""
+    index = current_app.config['mediaIndex']
+    version = current_app.config['media_cache'].version
+    if index.version != version:
+        index.reload(
+            getTagRows(),
+            dict(
+                db.session.query(Media.hash, Media.rotation)
+                .filter(Media.rotation.isnot(None))
+                .all()
+            ),
+            version
+        )
+    return index
+
+
+def refreshCatalog():
+    """Map the catalog snapshot again once init has rewritten it"""
+    catalog = current_app.config['mediaCatalog']
+    if not catalog.replaced():
+        return
+    with CATALOG_LOCK:
+        # Already mapped by another thread
+        if current_app.config['mediaCatalog'] is not catalog:
+            return
+        catalog = openCatalog(
+            current_app.config['dbPath'], current_app.config['configDir']
+        )
+        current_app.config['mediaIndex'] = MediaIndex(catalog, getTagRows())
+        current_app.config['mediaCatalog'] = catalog
+        indexUpdated(current_app.config['media_cache'].clear())
+
+
+def indexUpdated(version: int | None):
+    """Mark index current after updating it along with a write"""
+    if version is not None:
+        current_app.config['mediaIndex'].version = version
 
 
 def safeCommit() -> (bool, Exception):
@@ -275,39 +625,43 @@ def addTag():
             'success': False,
             'msg': "At least one media and tag must be selected!"
         }), 400
+    if not all(type(value) is str for value in hashes + tags):
+        return jsonify({
+            'success': False,
+            'msg': "Media and tags must be strings!"
+        }), 400
     forbiddenChars = {
         '&', '=', ','
     }
-    rows = []
     for tag in tags:
         if any(c in tag for c in forbiddenChars):
             return jsonify({
                 'success': False,
                 'msg': f"Characters {','.join(forbiddenChars)} not allowed!"
             }), 400
-        mediaWithTag = (
-            MediaTag.query
-            .with_entities(MediaTag.hash)
-            .filter_by(tag=tag)
-            .all()
+
+    # Existing pairs are skipped by the primary key
+    try:
+        db.session.execute(
+            sqliteInsert(MediaTag.__table__).on_conflict_do_nothing(),
+            [
+                {'hash': hash, 'tag': tag}
+                for tag in set(tags) for hash in set(hashes)
+            ]
         )
-        mediaWithTag = [m for (m,) in mediaWithTag]
-        for hash in hashes:
-            if hash in mediaWithTag:
-                continue
-            rows.append(MediaTag(
-                hash=hash,
-                tag=tag
-            ))
-    db.session.add_all(rows)
-    success, error = safeCommit()
+    except Exception as e:
+        db.session.rollback()
+        success, error = (False, e)
+    else:
+        success, error = safeCommit()
     if not success:
         return jsonify({
             'success': False,
-            'msg': error
+            'msg': str(error)
         }), 400
 
-    current_app.config['media_cache'] = {}
+    current_app.config['mediaIndex'].addTags(tags, hashes)
+    indexUpdated(current_app.config['media_cache'].invalidateTags(tags))
     return jsonify({
         'success': True,
     }), 200
@@ -330,24 +684,42 @@ def removeTag():
         }), 400
 
     hashes = data.get('hashes', [])
-    # No hash; delete any with tags
-    if hashes == [] or type(hashes) is not list:
-        for tag in tags:
-            db.session.query(MediaTag).filter(MediaTag.tag == tag).delete()
-    else:
-        for tag in tags:
+    if type(hashes) is not list:
+        hashes = []
+    if not all(type(value) is str for value in hashes + tags):
+        return jsonify({
+            'success': False,
+            'msg': "Media and tags must be strings!"
+        }), 400
+
+    try:
+        # No hash; delete any with tags
+        if hashes == []:
             db.session.query(MediaTag).filter(
-                MediaTag.tag == tag,
-                MediaTag.hash.in_(hashes)
-            ).delete()
-    success, error = safeCommit()
+                MediaTag.tag.in_(tags)
+            ).delete(synchronize_session=False)
+        else:
+            hashes = list(set(hashes))
+            for i in range(0, len(hashes), CHUNK_SIZE):
+                db.session.query(MediaTag).filter(
+                    MediaTag.tag.in_(tags),
+                    MediaTag.hash.in_(hashes[i:i + CHUNK_SIZE])
+                ).delete(synchronize_session=False)
+    except Exception as e:
+        db.session.rollback()
+        success, error = (False, e)
+    else:
+        success, error = safeCommit()
     if not success:
         return jsonify({
             'success': False,
-            'msg': error
+            'msg': str(error)
         }), 400
 
-    current_app.config['media_cache'] = {}
+    current_app.config['mediaIndex'].removeTags(
+        tags, hashes if hashes != [] else None
+    )
+    indexUpdated(current_app.config['media_cache'].invalidateTags(tags))
     return jsonify({
         'success': True,
     }), 200
@@ -370,29 +742,36 @@ def renameTag():
             'success': False,
             'msg': "Both old and new tags must be provided!"
         }), 400
+    if type(oldTag) is not str or type(newTag) is not str:
+        return jsonify({
+            'success': False,
+            'msg': "Tags must be strings!"
+        }), 400
 
-    rows = MediaTag.query.filter_by(tag=oldTag).all()
-
-    # Remove existing to prevent primary key collision
-    MediaTag.query.filter(
-        MediaTag.tag == newTag,
-        MediaTag.hash.in_(
-            {row.hash for row in rows}
+    # Media already tagged with the new tag keep a single row
+    tags = MediaTag.__table__
+    try:
+        db.session.execute(
+            update(tags)
+            .prefix_with('OR REPLACE')
+            .where(tags.c.tag == oldTag)
+            .values(tag=newTag)
         )
-    ).delete(synchronize_session=False)
-
-    for row in rows:
-        row.tag = newTag
-        db.session.add(row)
-
-    success, error = safeCommit()
+    except Exception as e:
+        db.session.rollback()
+        success, error = (False, e)
+    else:
+        success, error = safeCommit()
     if not success:
         return jsonify({
             'success': False,
-            'msg': error
+            'msg': str(error)
         }), 400
 
-    current_app.config['media_cache'] = {}
+    current_app.config['mediaIndex'].renameTag(oldTag, newTag)
+    indexUpdated(
+        current_app.config['media_cache'].invalidateTags((oldTag, newTag))
+    )
     return jsonify({
         'success': True,
     }), 200
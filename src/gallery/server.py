@@ -0,0 +1,82 @@
+from flask import Flask
+from models import db
+
+# Servers selectable with mode under [server]
+SERVER_MODES = ('development', 'waitress', 'gunicorn', 'uvicorn')
+
+
+def runServer(app: Flask, options: dict):
+    mode = options.get('mode', 'development')
+    host, port = options['host'], options['port']
+    threads = options.get('threads', 8)
+    keepalive = options.get('keepalive', 5)
+    timeout = options.get('timeout', 60)
+
+    if mode == 'development':
+        app.run(debug=True, host=host, port=port)
+    elif mode == 'waitress':
+        try:
+            from waitress import serve
+        except ImportError:
+            print("Server mode 'waitress' requires the waitress package")
+            return
+        # Single process; in-memory indexes shared by all threads
+        serve(
+            app,
+            host=host,
+            port=port,
+            threads=threads,
+            # Covers idle keep-alive and stalled connections alike
+            channel_timeout=timeout
+        )
+    elif mode == 'gunicorn':
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError:
+            print("Server mode 'gunicorn' requires the gunicorn package")
+            return
+
+        class GunicornServer(BaseApplication):
+            def load_config(self):
+                for key, value in {
+                    'bind': f'{host}:{port}',
+                    'workers': options.get('workers', 2),
+                    'worker_class': 'gthread',
+                    'threads': threads,
+                    'keepalive': keepalive,
+                    'timeout': timeout,
+                    # Indexes are built once and inherited by workers
+                    'preload_app': True,
+                    'post_fork': postFork,
+                }.items():
+                    self.cfg.set(key, value)
+
+            def load(self):
+                return app
+
+        def postFork(server, worker):
+            # Connections opened before the fork belong to the master
+            with app.app_context():
+                db.engine.dispose(close=False)
+
+        GunicornServer().run()
+    elif mode == 'uvicorn':
+        try:
+            import uvicorn
+            from gallery.asgi import MediaASGI
+        except ImportError:
+            print("Server mode 'uvicorn' requires the uvicorn package")
+            return
+        # One event loop; file reads and other routes use the thread pool
+        uvicorn.run(
+            MediaASGI(app, threads=threads),
+            host=host,
+            port=port,
+            lifespan='off',
+            timeout_keep_alive=keepalive
+        )
+    else:
+        print(
+            f"Unknown server mode '{mode}', "
+            f"expected one of {', '.join(SERVER_MODES)}"
+        )
@@ -0,0 +1,53 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import RLock
+from gallery.indexer import ThumbnailOptions, generateThumbnails
+
+
+class ThumbnailQueue:
+    """
+    Generate missing thumbnails on a bounded pool of background threads.
+    Concurrent requests for the same media share a single render.
+    """
+
+    def __init__(
+        self,
+        thumbnails: ThumbnailOptions,
+        workers: int = 2,
+        maxPending: int = 256
+    ):
+        self.thumbnails = thumbnails
+        self.maxPending = maxPending
+        # Threads start on first submit
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='thumbnail'
+        )
+        self.pending = {}
+        self.lock = RLock()
+
+    def request(
+        self,
+        hash: str,
+        mediaPath: str,
+        duration: str = None
+    ) -> Future | None:
+        """Future for thumbnails of hash, or None if the queue is full"""
+        with self.lock:
+            future = self.pending.get(hash)
+            if future is not None:
+                return future
+
+            if len(self.pending) >= self.maxPending:
+                return None
+
+            future = self.executor.submit(
+                generateThumbnails,
+                mediaPath, hash, self.thumbnails, duration
+            )
+            self.pending[hash] = future
+        future.add_done_callback(lambda _: self._done(hash))
+        return future
+
+    def _done(self, hash: str):
+        with self.lock:
+            self.pending.pop(hash, None)
@@ -1,6 +1,9 @@
 from PIL import Image
 from pillow_heif import register_heif_opener
 from utils.paths import CreatePath
+from os.path import join as pathJoin
+from os import getpid, replace
+from tempfile import TemporaryDirectory
 import ffmpeg
 
 
@@ -8,40 +11,105 @@ import ffmpeg
 register_heif_opener()
 
 
-def ImgThumbnail(imgPath: str, thumbnailPath: str, size: int):
-    # Copy of original to prevent modification
-    img = Image.open(imgPath).copy()
-    w, h = img.width, img.height
-    if w < h:
-        size = int((h / w) * size)
-    else:
-        size = int((w / h) * size)
-    img.thumbnail((size, size))
-
-    CreatePath(thumbnailPath)
-
+def SaveThumbnail(img: Image.Image, paths: list[str], quality: dict = None):
+    """Save image to each path, format and quality chosen by extension"""
     # Disgard alpha channel in case of jpg
     img = img.convert("RGB")
-    img.save(thumbnailPath)
+    for path in paths:
+        ext = path[path.rfind(".") + 1:].lower()
+        CreatePath(path)
 
+        options = {}
+        if quality and ext in quality:
+            options['quality'] = quality[ext]
 
-def VidThumbnail(vidPath: str, thumbnailPath: str, size: int):
-    CreatePath(thumbnailPath)
+        # Write then rename so readers never see a partial file
+        tmpPath = f'{path}.{getpid()}.tmp'
+        img.save(
+            tmpPath,
+            format=Image.registered_extensions()[f'.{ext}'],
+            **options
+        )
+        replace(tmpPath, path)
+
+
+def ImgThumbnails(
+    imgPath: str,
+    thumbnailPaths: dict[int, list[str]],
+    quality: dict = None
+):
+    """Generate thumbnails of every size from a single decode"""
+    with Image.open(imgPath) as img:
+        w, h = img.width, img.height
+        # Shorter side is set to size
+        ratio = max(w, h) / min(w, h)
+        sizes = sorted(thumbnailPaths, reverse=True)
+
+        # Decode at reduced scale near the largest size; JPEG scales in
+        # the decoder, HEIF/AVIF use an embedded thumbnail if large enough
+        scale = sizes[0] / min(w, h)
+        img.draft('RGB', (int(w * scale) or 1, int(h * scale) or 1))
+        img.load()
+
+        # Derive each size from the previous, larger one
+        for size in sizes:
+            img.thumbnail((int(ratio * size), int(ratio * size)))
+            SaveThumbnail(img, thumbnailPaths[size], quality)
+
+
+def ImgThumbnail(imgPath: str, thumbnailPath: str, size: int):
+    ImgThumbnails(imgPath, {size: [thumbnailPath]})
+
+
+def VidThumbnails(
+    vidPath: str,
+    thumbnailPaths: dict[int, list[str]],
+    duration: str = None,
+    quality: dict = None
+):
+    """Generate thumbnails of every size from a single ffmpeg run"""
+    sizes = list(thumbnailPaths)
 
-    (
+    # Seek into the video to skip intros and fades; input seeking jumps
+    # to the nearest keyframe without decoding
+    inputArgs = {}
+    if duration:
+        minutes, seconds = duration.split(':')
+        inputArgs['ss'] = (int(minutes) * 60 + int(seconds)) // 10
+
+    frames = (
         ffmpeg
-        .input(vidPath)
-        # Split stream for thumbnail filtering
-        .filter_multi_output('split')[0]
-        # Select representative frame
+        .input(vidPath, **inputArgs)
+        .video
+        # Select representative frame once
         .filter('thumbnail')
-        # Set shorter side to size and keep aspect ratio
-        .filter(
-            'scale',
-            w='if(gt(iw,ih),-1,{0})'.format(size),
-            h='if(gt(iw,ih),{0},-1)'.format(size)
-        )
-        # Output single frame
-        .output(thumbnailPath, vframes=1)
-        .run(capture_stdout=True, capture_stderr=True)
+        # Copy selected frame for each size
+        .filter_multi_output('split', len(sizes))
     )
+
+    # Lossless frames, encoded by Pillow into each format
+    with TemporaryDirectory() as tmpDir:
+        framePaths = [pathJoin(tmpDir, f'{size}.png') for size in sizes]
+        (
+            ffmpeg.merge_outputs(*[
+                frames[i]
+                # Set shorter side to size and keep aspect ratio
+                .filter(
+                    'scale',
+                    w='if(gt(iw,ih),-1,{0})'.format(size),
+                    h='if(gt(iw,ih),{0},-1)'.format(size)
+                )
+                # Output single frame
+                .output(framePaths[i], vframes=1)
+                for i, size in enumerate(sizes)
+            ])
+            .run(capture_stdout=True, capture_stderr=True)
+        )
+
+        for size, framePath in zip(sizes, framePaths):
+            with Image.open(framePath) as frame:
+                SaveThumbnail(frame, thumbnailPaths[size], quality)
+
+
+def VidThumbnail(vidPath: str, thumbnailPath: str, size: int):
+    VidThumbnails(vidPath, {size: [thumbnailPath]})
@@ -1,5 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask
+from sqlalchemy import inspect, text
+from utils.paths import SplitMediaPath
 
 db = SQLAlchemy()
 
@@ -9,3 +11,67 @@ def init_db(app: Flask):
 
     with app.app_context():
         db.create_all()
+        upgrade_schema()
+
+
+# Version of catalog data (media, paths, scan mtimes, rotations), kept in
+# the SQLite header so snapshots can be checked against it
+def catalog_version() -> int:
+    return db.session.execute(text('PRAGMA user_version')).scalar()
+
+
+# Bump catalog version; called after the writes so it commits with them
+def bump_catalog_version() -> int:
+    db.session.flush()
+    version = catalog_version() + 1
+    db.session.execute(text(f'PRAGMA user_version = {version}'))
+    return version
+
+
+# Add columns missing from tables created by an older version
+def upgrade_schema():
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+
+                ddl = (
+                    f'ALTER TABLE {table.name} ADD COLUMN {column.name} '
+                    f'{column.type.compile(dialect=db.engine.dialect)}'
+                )
+                # Existing rows take the default
+                if column.server_default is not None:
+                    ddl += f" DEFAULT '{column.server_default.arg}'"
+                    if not column.nullable:
+                        ddl += ' NOT NULL'
+                conn.execute(text(ddl))
+
+            # Indexes added since the table was created
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+        backfill_media_paths(conn)
+
+
+# Fill columns derived from path for rows stored before they existed
+def backfill_media_paths(conn):
+    paths = conn.execute(
+        text('SELECT path FROM media_path WHERE extension IS NULL')
+    ).scalars().all()
+    if not paths:
+        return
+
+    print(f'Indexing {len(paths)} media paths')
+    conn.execute(
+        text(
+            'UPDATE media_path SET parent_dir = :parent, extension = :ext '
+            'WHERE path = :path'
+        ),
+        [
+            dict(zip(('parent', 'ext'), SplitMediaPath(path)), path=path)
+            for path in paths
+        ]
+    )
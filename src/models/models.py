@@ -4,6 +4,11 @@ from . import db
 class Media(db.Model):
     __tablename__ = 'media'
     hash = db.Column(db.String, primary_key=True)
+    hashalgorithm = db.Column(
+        db.String, nullable=False, server_default='sha1'
+    )
+    # Full content hash when keyed by a quick hash, once verified
+    fullhash = db.Column(db.String, nullable=True)
 
     # Stores as epoch time
     datetime = db.Column(db.Integer)
@@ -31,12 +36,34 @@ class Media(db.Model):
 class MediaPath(db.Model):
     __tablename__ = 'media_path'
     path = db.Column(db.String, primary_key=True)
-    hash = db.Column(db.String, db.ForeignKey('media.hash'), nullable=False)
+    hash = db.Column(
+        db.String, db.ForeignKey('media.hash'), nullable=False, index=True
+    )
+    # Derived from path for indexed filters
+    parent_dir = db.Column(db.String, nullable=True, index=True)
+    extension = db.Column(db.String, nullable=True, index=True)
     # Bidirectional access
     media = db.relationship('Media', backref=db.backref('media_paths', lazy=True))
 
 
 class MediaTag(db.Model):
     __table_name__ = 'media_tag'
+    # Lookups by tag; primary key covers lookups by hash
+    __table_args__ = (db.Index('ix_media_tag_tag_hash', 'tag', 'hash'),)
     hash = db.Column(db.String, db.ForeignKey('media.hash'), primary_key=True)
     tag = db.Column(db.String, primary_key=True)
+
+
+class ScanEntry(db.Model):
+    __tablename__ = 'scan_manifest'
+    path = db.Column(db.String, primary_key=True)
+    hash = db.Column(db.String, nullable=False)
+    hashalgorithm = db.Column(
+        db.String, nullable=False, server_default='sha1'
+    )
+
+    # Stat signature at time of hashing
+    size = db.Column(db.Integer, nullable=False)
+    # Modification time in nanoseconds
+    mtime = db.Column(db.Integer, nullable=False)
+    inode = db.Column(db.Integer, nullable=False)
@@ -13,6 +13,7 @@ import { lightbox } from "./ui/lightbox.js";
 import { openInputPrompt, closeInputPrompt, showInputErr } from "./ui/prompt.js";
 import { createToast } from "./ui/toast.js";
 import { api_rotate } from "./utils/api.js";
+import { decodeColumnar } from "./utils/columnar.js";
 
 const GALLERY_CONTAINER = document.getElementById('gallery');
 const STATS_ELEM = document.getElementById('stats');
@@ -38,11 +39,37 @@ let lastActiveMode = Modes.none;
 
 let handleInputExtra = null;
 
-// Fetch media info from API
-async function updateAllMedia(queryParams='') {
-	const response = await fetch('/api/media' + queryParams);
-	const jsonResp = await response.json();
-	mediaState.setNewMedia(jsonResp['data']);
+const MEDIA_PAGE_SIZE = 2000;
+let mediaLoadId = 0;
+
+// Fetch media info from API a page at a time
+// Returns false if superseded by a newer load
+async function updateAllMedia(queryParams='', onFirstPage=null) {
+	const loadId = ++mediaLoadId;
+	const pageParams = (queryParams ? queryParams + '&' : '?') +
+		'format=columnar&limit=' + MEDIA_PAGE_SIZE;
+	let data = [];
+	let cursor = null;
+	do {
+		const response = await fetch(
+			'/api/media' + pageParams + (cursor ? '&cursor=' + cursor : '')
+		);
+		const page = decodeColumnar(await response.arrayBuffer());
+		if (loadId !== mediaLoadId) {
+			return false;
+		}
+
+		data.push(...page.items);
+		cursor = page.next;
+		// Show first page while the rest loads
+		if (cursor && onFirstPage && data.length === page.items.length) {
+			mediaState.setNewMedia(data);
+			onFirstPage();
+		}
+	} while (cursor);
+
+	mediaState.setNewMedia(data);
+	return true;
 }
 
 async function loadMedia({pushState = true} = {}) {
@@ -222,8 +249,29 @@ async function loadMediaByFilter({
 			queryparam.push("types=" + filterState.getTypes().join(','));
 		}
 
+		const showMedia = () => {
+			updateStats();
+
+			if (mediaState.getMediaListSize() === 0) {
+				GALLERY_CONTAINER.innerHTML = '<div class="error">No images found.</div>';
+			}
+			else {
+				renderGallery({
+					indexedMedia: mediaState.getAllMediaIndexed(),
+					parentElem: GALLERY_CONTAINER,
+					handleImgClick: openLightbox,
+					handleCheckboxMouseDown: handleCheckboxMouseDown,
+					handleCheckboxMouseEnter: handleCheckboxMouseEnter,
+					handleCheckboxTouchStart: handleCheckboxTouchStart,
+					handleCheckboxTouchEnd: handleCheckboxTouchEnd,
+				});
+			}
+		};
+
 		const joinedParams = queryparam.length > 0 ? ("?" + queryparam.join('&')) : '';
-		await updateAllMedia(joinedParams);
+		if (!await updateAllMedia(joinedParams, showMedia)) {
+			return;
+		}
 		if (pushState) {
 			window.history.pushState(
 				{}, '',
@@ -235,22 +283,7 @@ async function loadMediaByFilter({
 		pathFilter.innerHTML = '';
 		pathFilter.appendChild(createPathButtons(path, addPathFilter));
 
-		updateStats();
-
-		if (mediaState.getMediaListSize() === 0) {
-			GALLERY_CONTAINER.innerHTML = '<div class="error">No images found.</div>';
-		}
-		else {
-			renderGallery({
-				indexedMedia: mediaState.getAllMediaIndexed(),
-				parentElem: GALLERY_CONTAINER,
-				handleImgClick: openLightbox,
-				handleCheckboxMouseDown: handleCheckboxMouseDown,
-				handleCheckboxMouseEnter: handleCheckboxMouseEnter,
-				handleCheckboxTouchStart: handleCheckboxTouchStart,
-				handleCheckboxTouchEnd: handleCheckboxTouchEnd,
-			});
-		}
+		showMedia();
 
 		updateAllTags();
 		mediaState.setCurrentMedia(0);
@@ -1,3 +1,5 @@
+import { queueThumbnail } from "../utils/thumbnails.js";
+
 // Intersection Observer setup for lazy loading
 export let observer;
 
@@ -11,7 +13,13 @@ export function setupObserver() {
 				if (entry.isIntersecting) {
 					const item = entry.target;
 					if (!item.src) {
-						item.src = item.dataset.src;
+						if (item.dataset.hash) {
+							// Fetched together with other tiles in view
+							queueThumbnail(item);
+						}
+						else {
+							item.src = item.dataset.src;
+						}
 						observer.unobserve(item);
 					}
 				}
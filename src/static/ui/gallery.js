@@ -82,6 +82,7 @@ export function renderGallery({
 				});
 
 			createLazyImg({ src: `/media/${img.hash}/thumbnail` })
+				.setData('hash', img.hash)
 				.className('gallery-media')
 				.setStyles({
 					width: '100%',
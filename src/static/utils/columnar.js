@@ -0,0 +1,65 @@
+const MAGIC = 'SGC1';
+const decoder = new TextDecoder();
+
+// Decode /api/media?format=columnar; see gallery/columnar.py for layout
+// Returns [hash, info] items as in the JSON listing and the next cursor
+export function decodeColumnar(buffer) {
+	const view = new DataView(buffer);
+	if (decoder.decode(new Uint8Array(buffer, 0, 4)) !== MAGIC) {
+		throw new Error('Not a columnar media listing');
+	}
+	const count = view.getUint32(4, true);
+
+	let offset = 16;
+	const column = (ArrayType) => {
+		const values = new ArrayType(buffer, offset, count);
+		offset += count * ArrayType.BYTES_PER_ELEMENT;
+		return values;
+	};
+	const sizes = column(Float64Array);
+	const ratios = column(Float32Array);
+	const widths = column(Uint32Array);
+	const heights = column(Uint32Array);
+	const dirIndex = column(Uint32Array);
+	const rotations = column(Int16Array);
+	const videos = column(Uint8Array);
+	const hashLengths = column(Uint8Array);
+	offset += (4 - offset % 4) % 4;
+
+	const blob = () => {
+		const length = view.getUint32(offset, true);
+		const bytes = new Uint8Array(buffer, offset + 4, length);
+		offset += 4 + length;
+		return bytes;
+	};
+	const hashes = blob();
+	const dirs = decoder.decode(blob()).split('\0');
+	const names = decoder.decode(blob()).split('\0');
+	const durations = decoder.decode(blob()).split('\0');
+	const next = decoder.decode(blob()) || null;
+
+	const items = new Array(count);
+	let hashOffset = 0;
+	for (let i = 0; i < count; i++) {
+		let hash = '';
+		for (let j = 0; j < hashLengths[i]; j++) {
+			hash += hashes[hashOffset + j].toString(16).padStart(2, '0');
+		}
+		hashOffset += hashLengths[i];
+
+		const dir = dirs[dirIndex[i]];
+		items[i] = [hash, {
+			name: names[i],
+			aspectRatio: ratios[i],
+			video: videos[i] === 1,
+			duration: durations[i] || null,
+			rotation: rotations[i],
+			width: widths[i],
+			height: heights[i],
+			path: dir ? dir + '/' + names[i] : names[i],
+			size: sizes[i]
+		}];
+	}
+
+	return { items, next };
+}
@@ -0,0 +1,128 @@
+// Wait for other tiles entering view before requesting a batch
+const BATCH_DELAY = 16;
+const MAX_BATCH = 200;
+// Keep request lines below common server limits
+const MAX_QUERY_LENGTH = 3000;
+// Thumbnails kept for re-rendered tiles before their URLs are revoked
+const MAX_CACHED = 5000;
+const BUNDLE_MAGIC = 'SGT1';
+
+const decoder = new TextDecoder();
+// hash -> img elements waiting for its thumbnail
+let pending = new Map();
+let flushTimer = null;
+// hash -> object URL of a loaded thumbnail, oldest first
+const loaded = new Map();
+
+// Bundles are not negotiated by the image loader; only claim formats the
+// browser can encode, which it can also decode
+const ACCEPT = (
+	document.createElement('canvas').toDataURL('image/webp').startsWith('data:image/webp')
+) ? 'image/webp,image/jpeg' : 'image/jpeg';
+
+// Load thumbnail of img from a batch request, falls back to its own URL
+export function queueThumbnail(img) {
+	const hash = img.dataset.hash;
+	const url = loaded.get(hash);
+	if (url) {
+		img.src = url;
+		return;
+	}
+	if (!pending.has(hash)) {
+		pending.set(hash, []);
+	}
+	pending.get(hash).push(img);
+
+	if (flushTimer === null) {
+		flushTimer = setTimeout(flush, BATCH_DELAY);
+	}
+}
+
+function flush() {
+	const batch = pending;
+	pending = new Map();
+	flushTimer = null;
+
+	// Sorted so the same tiles give the same, cacheable URL
+	const hashes = Array.from(batch.keys()).sort();
+	let start = 0, length = 0;
+	for (let i = 0; i < hashes.length; i++) {
+		if (
+			i - start === MAX_BATCH ||
+			length + hashes[i].length + 1 > MAX_QUERY_LENGTH
+		) {
+			loadBatch(hashes.slice(start, i), batch);
+			start = i;
+			length = 0;
+		}
+		length += hashes[i].length + 1;
+	}
+	if (start < hashes.length) {
+		loadBatch(hashes.slice(start), batch);
+	}
+}
+
+function cacheThumbnail(hash, blob) {
+	const url = URL.createObjectURL(blob);
+	loaded.set(hash, url);
+	// Displayed images stay decoded after their URL is revoked
+	if (loaded.size > MAX_CACHED) {
+		const [oldest, oldestUrl] = loaded.entries().next().value;
+		loaded.delete(oldest);
+		URL.revokeObjectURL(oldestUrl);
+	}
+	return url;
+}
+
+async function loadBatch(hashes, batch) {
+	let thumbnails = new Map();
+	try {
+		const response = await fetch(
+			`/api/thumbnails?hashes=${hashes.join(',')}`,
+			{ headers: { 'Accept': ACCEPT } }
+		);
+		if (response.ok) {
+			thumbnails = parseBundle(await response.arrayBuffer());
+		}
+	} catch (error) {
+		console.error('Error loading thumbnails:', error);
+	}
+
+	for (const hash of hashes) {
+		const blob = thumbnails.get(hash);
+		const url = blob ? cacheThumbnail(hash, blob) : null;
+		for (const img of batch.get(hash)) {
+			img.src = url || img.dataset.src;
+		}
+	}
+}
+
+// See thumbnailBundle in gallery/routes.py for layout
+function parseBundle(buffer) {
+	const view = new DataView(buffer);
+	const thumbnails = new Map();
+	if (decoder.decode(new Uint8Array(buffer, 0, 4)) !== BUNDLE_MAGIC) {
+		return thumbnails;
+	}
+
+	let offset = 4;
+	const readString = () => {
+		const length = view.getUint8(offset);
+		const str = decoder.decode(new Uint8Array(buffer, offset + 1, length));
+		offset += 1 + length;
+		return str;
+	};
+	while (offset < buffer.byteLength) {
+		const hash = readString();
+		const mimetype = readString();
+		const length = view.getUint32(offset, true);
+		offset += 4;
+		if (length > 0) {
+			thumbnails.set(hash, new Blob(
+				[new Uint8Array(buffer, offset, length)], { type: mimetype }
+			));
+		}
+		offset += length;
+	}
+	return thumbnails;
+}
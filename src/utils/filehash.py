@@ -1,11 +1,98 @@
 import hashlib
+from os import fstat
+from os.path import getsize
+import mmap
 
-def SHA1(fpath):
-    h = hashlib.sha1()
+# Optional fast non-cryptographic hash for dedup-only use
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+# Read size per update; large reads keep Python-level calls low
+BUFFER_SIZE = 1024 * 1024
+
+HASH_ALGORITHMS = {
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+}
+if xxhash is not None:
+    HASH_ALGORITHMS['xxh128'] = xxhash.xxh3_128
+
+DEFAULT_ALGORITHM = 'sha1'
+
+# Bytes sampled from head, middle and tail for quick hashes
+QUICK_SAMPLE_SIZE = 1024 * 1024
+QUICK_PREFIX = 'quick-'
+
+
+def GetHasher(algorithm: str):
+    if algorithm not in HASH_ALGORITHMS:
+        if algorithm == 'xxh128':
+            raise ValueError("Hash 'xxh128' requires the xxhash package")
+        raise ValueError(
+            f"Unknown hash '{algorithm}', "
+            f"expected one of {', '.join(HASH_ALGORITHMS)}"
+        )
+    return HASH_ALGORITHMS[algorithm]()
+
+
+def HashFile(
+    fpath: str,
+    algorithm: str = DEFAULT_ALGORITHM,
+    useMmap: bool = False
+) -> str:
+    h = GetHasher(algorithm)
     with open(fpath, 'rb') as f:
-        chunk = f.read(1024)
-        while chunk:
-            h.update(chunk)
-            chunk = f.read(1024)
+        # Hash whole file in one call from the page cache
+        if useMmap and fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+            return h.hexdigest()
+
+        # Reuse a single buffer across reads
+        buffer = bytearray(BUFFER_SIZE)
+        view = memoryview(buffer)
+        while n := f.readinto(buffer):
+            h.update(view[:n])
     return h.hexdigest()
 
+
+def QuickHashFile(
+    fpath: str,
+    algorithm: str = DEFAULT_ALGORITHM,
+    useMmap: bool = False
+) -> (str, str):
+    """
+    Hash of file size and samples from head, middle and tail. Files too
+    small to sample are hashed in full. Returns hash and algorithm name.
+    """
+    size = getsize(fpath)
+    if size <= 3 * QUICK_SAMPLE_SIZE:
+        return (HashFile(fpath, algorithm, useMmap), algorithm)
+
+    h = GetHasher(algorithm)
+    h.update(size.to_bytes(8, 'little'))
+
+    buffer = bytearray(QUICK_SAMPLE_SIZE)
+    view = memoryview(buffer)
+    with open(fpath, 'rb') as f:
+        for offset in (
+            0,
+            (size - QUICK_SAMPLE_SIZE) // 2,
+            size - QUICK_SAMPLE_SIZE
+        ):
+            f.seek(offset)
+            n = f.readinto(buffer)
+            h.update(view[:n])
+    return (h.hexdigest(), QUICK_PREFIX + algorithm)
+
+
+def FullAlgorithm(algorithm: str) -> str:
+    return algorithm.removeprefix(QUICK_PREFIX)
+
+
+def SHA1(fpath):
+    return HashFile(fpath, 'sha1')
@@ -1,4 +1,4 @@
-from os.path import dirname, exists
+from os.path import dirname, exists, split, splitext
 from os import makedirs
 
 
@@ -7,3 +7,9 @@ def CreatePath(newPath):
     output_dir = dirname(newPath)
     if output_dir and not exists(output_dir):
         makedirs(output_dir, exist_ok=True)
+
+
+# Parent directory and lowercase extension without dot of a media path
+def SplitMediaPath(path: str) -> (str, str):
+    parent, name = split(path)
+    return (parent, splitext(name)[1][1:].lower())
@@ -0,0 +1,105 @@
+"""
+Query plans of getMediaInfo over combinations of its filters. Every
+selective filter (path prefix, tags, extensions) must be answered from an
+index; a full scan of media_path is only expected when nothing narrows
+the rows, which includes excluded tags (itags) and video or image, alone
+or OR'd with extensions: those are checked per row against media_tag and
+media by primary key.
+"""
+from itertools import product
+
+import pytest
+from flask import Flask
+from sqlalchemy import event
+
+from models import db, init_db
+from gallery.media import getMediaInfo
+
+PATH_FILTERS = [None, 'images/a/']
+TAG_FILTERS = [None, ['t1'], ['t1', 't2']]
+ITAG_FILTERS = [None, ['x']]
+TYPE_FILTERS = [
+    None, ['video'], ['image'], ['jpg'], ['video', 'jpg'],
+    ['video', 'image', 'jpg']
+]
+SORTS = ['path', 'datetime']
+CURSORS = [False, True]
+COMBINATIONS = list(product(
+    PATH_FILTERS, TAG_FILTERS, ITAG_FILTERS, TYPE_FILTERS, SORTS, CURSORS
+))
+
+
+@pytest.fixture(scope='module')
+def app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    init_db(app)
+    with app.app_context():
+        yield app
+
+
+def queryPlan(**filters) -> list[str]:
+    """Plan details of the statement getMediaInfo runs for filters"""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        getMediaInfo(limit=10, **filters)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+
+    statement, parameters = statements[-1]
+    conn = db.session.connection().connection.dbapi_connection
+    return [
+        row[3] for row in
+        conn.execute(f'EXPLAIN QUERY PLAN {statement}', parameters)
+    ]
+
+
+def isSelective(pathFilter, tagsFilter, typeFilter) -> bool:
+    typeFilter = typeFilter or []
+    extensions = [t for t in typeFilter if t not in ('video', 'image')]
+    # Extensions OR'd with video or image still match per row
+    byKind = ('video' in typeFilter) != ('image' in typeFilter)
+    return bool(pathFilter or tagsFilter or (extensions and not byKind))
+
+
+@pytest.mark.parametrize(
+    'pathFilter, tagsFilter, itagsFilter, typeFilter, sort, cursor',
+    COMBINATIONS
+)
+def test_filters_use_indexes(
+    app, pathFilter, tagsFilter, itagsFilter, typeFilter, sort, cursor
+):
+    after = None
+    if cursor:
+        after = ['images/b']
+        if sort == 'datetime':
+            after = [1700000000, 'images/b']
+    plan = queryPlan(
+        pathFilter=pathFilter,
+        tagsFilter=tagsFilter,
+        itagsFilter=itagsFilter,
+        typeFilter=typeFilter,
+        sort=sort,
+        after=after
+    )
+    scans = [detail for detail in plan if detail.startswith('SCAN')]
+
+    # Joined and correlated tables are always looked up by key
+    assert not [s for s in scans if not s.startswith('SCAN media_path')], plan
+
+    if isSelective(pathFilter, tagsFilter, typeFilter):
+        assert not scans, plan
+
+
+def test_itags_only_scans_paths(app):
+    # Exclusion cannot narrow rows; each path is probed in media_tag
+    plan = queryPlan(itagsFilter=['x'])
+    assert any(detail.startswith('SCAN media_path') for detail in plan)
+    assert any(
+        detail.startswith('SEARCH media_tag') for detail in plan
+    ), plan